@@ -0,0 +1,450 @@
+import gc
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from copy import deepcopy
+
+import networkx as nx
+import numpy as np
+import pandas as pd
+
+from core.clustering import Clustering
+from core.dag import TopologicalOrder
+from core.infer import Infer
+from core.scanner import LogBatch, LogEvent, TemplateScanner, calc_similarity
+from core.store import ModelStore
+from core.stream import StreamingInfer, parse_time
+from core.topology import Topology
+
+
+def load_messages(data_path, n_files):
+    """
+    读取训练数据目录下所有告警的事件内容主体文字信息
+    :param data_path: 数据目录
+    :param n_files: 文件个数
+    :return: 文字信息列表
+    """
+
+    messages = []
+    for i in range(n_files):
+        df = pd.read_csv('{}/{}.csv'.format(data_path, i))
+        messages.extend(event.split(' ', 1)[1] for event in df['triggername'])
+    return messages
+
+
+def bench_template_matching():
+    """
+    对比线性扫描与模板索引两种模板匹配方式的耗时，并校验两者结果一致
+    :return: 无
+    """
+
+    ts = TemplateScanner('data/test')
+    messages = load_messages('data/train', 100)
+    templates = ts.get_templates()
+
+    def linear(message):
+        for target_message, idx in templates:
+            if calc_similarity(target_message, message) > ts.log_parse_similarity_threshold:
+                return idx
+
+    start = time.perf_counter()
+    expected = [linear(message) for message in messages]
+    linear_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = [ts.get_template_id(message) for message in messages]
+    index_time = time.perf_counter() - start
+
+    assert expected == actual, '模板索引与线性扫描的结果不一致'
+    print('告警条数: {}'.format(len(messages)))
+    print('线性扫描: {:.3f}s'.format(linear_time))
+    print('模板索引: {:.3f}s（加速 {:.1f} 倍）'.format(index_time, linear_time / index_time))
+
+
+def measure(func):
+    """
+    执行函数并统计耗时与内存占用
+    :param func: 待执行的函数
+    :return: 元组(返回值, 耗时（秒）, 执行结束时仍占用的内存（MB）, 内存峰值（MB）)
+    """
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, current / 1024 / 1024, peak / 1024 / 1024
+
+
+def clock(func):
+    """
+    执行函数并统计耗时，执行前回收此前遗留的垃圾并在执行期间暂停垃圾回收，
+    避免前一段被测代码产生的对象在后一段的计时中被回收
+    :param func: 待执行的函数
+    :return: 元组(返回值, 耗时（秒）)
+    """
+
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        result = func()
+        return result, time.perf_counter() - start
+    finally:
+        gc.enable()
+
+
+def bench_ingest():
+    """
+    对比逐行构造dict与列式解析两种读取告警文件方式的耗时与内存峰值
+    :return: 无
+    """
+
+    ts = TemplateScanner('data/test')
+    export = pd.concat([pd.read_csv('data/train/{}.csv'.format(i)) for i in range(100)]).to_csv(index=False)
+
+    def by_rows():
+        entries = []
+        for index, event in pd.read_csv(io.StringIO(export)).iterrows():
+            msg_raw = event['triggername'].split(' ', 1)
+            entries.append({
+                'node': int(msg_raw[0].split('_')[1]),
+                'message': msg_raw[1],
+                'template': ts.get_template_id(msg_raw[1]),
+                'is_root': int(event['is_root']) == 1
+            })
+        return entries
+
+    expected, rows_time, _, rows_peak = measure(by_rows)
+    batch, batch_time, _, batch_peak = measure(lambda: ts.parse(io.StringIO(export), True))
+
+    assert expected == batch.to_dicts(), '列式解析与逐行解析的结果不一致'
+    print('告警条数: {}'.format(len(batch)))
+    print('逐行解析: {:.3f}s，内存峰值 {:.1f}MB'.format(rows_time, rows_peak))
+    print('列式解析: {:.3f}s，内存峰值 {:.1f}MB'.format(batch_time, batch_peak))
+
+
+def load_export(ts, data_path, n_files):
+    """
+    将多个训练数据文件合并解析为一个LogBatch，模拟大规模的告警导出
+    :param ts: 日志模板扫描器
+    :param data_path: 数据目录
+    :param n_files: 文件个数
+    :return: LogBatch
+    """
+
+    export = pd.concat([pd.read_csv('{}/{}.csv'.format(data_path, i)) for i in range(n_files)]).to_csv(index=False)
+    return ts.parse(io.StringIO(export), True)
+
+
+def bench_clustering():
+    """
+    对比基于dict列表与基于下标视图两种聚类预处理（过滤高频项、去重、统计频率）的耗时，并校验两者结果一致
+    :return: 无
+    """
+
+    ts = TemplateScanner('data/test')
+    top = Topology('data/topology/topology_edges_node.json')
+    export = load_export(ts, 'data/train', 100)
+    rng = np.random.RandomState(0)
+
+    def by_dicts(logs):
+        clustered_logs = deepcopy(logs.to_dicts())
+        clustered_logs = [log for log in clustered_logs if ts.get_freq(log['template']) <= Clustering.freq_threshold]
+        event_freq = defaultdict(int)
+        result = []
+        for log in clustered_logs:
+            event_freq[(log['node'], log['template'])] += 1
+            if log not in result:
+                result.append(log)
+        event_freq = {k: v / len(clustered_logs) for k, v in event_freq.items()}
+        mapping = defaultdict(list)
+        for log in result:
+            mapping[log['node']].append(log)
+        return mapping, event_freq
+
+    for size in (1000, 10000, 100000):
+        logs = export.take(rng.randint(0, len(export), size))
+        (expected_mapping, expected_freq), dicts_time, _, dicts_peak = measure(lambda: by_dicts(logs))
+        cl, index_time, _, index_peak = measure(lambda: Clustering(ts, top, logs))
+
+        mapping = {node: [log.to_dict() for log in node_logs]
+                   for node, node_logs in cl.get_node_to_log_mapping().items()}
+        assert expected_mapping == mapping, '聚类结果不一致'
+        assert all(expected_freq[k] == cl.get_event_freq(LogEvent(k[0], '', k[1])) for k in expected_freq), \
+            '事件频率不一致'
+        print('{}条告警: dict列表 {:.3f}s，内存峰值 {:.1f}MB；下标视图 {:.3f}s，内存峰值 {:.1f}MB'.format(
+            size, dicts_time, dicts_peak, index_time, index_peak))
+
+
+def bench_topology(n_nodes=200000, n_children=5, n_queries=2000):
+    """
+    在随机生成的大规模拓扑上，对比networkx与CSR两种拓扑存储方式的加载耗时、内存占用以及遍历速度
+    :param n_nodes: 节点个数
+    :param n_children: 每个节点的子节点个数
+    :param n_queries: 遍历的起始节点个数
+    :return: 无
+    """
+
+    rng = np.random.RandomState(0)
+    graph = {}
+    for node in range(n_nodes):
+        children = rng.randint(node + 1, min(node + 1000, n_nodes - 1) + 1, n_children) if node + 1 < n_nodes else []
+        graph['node_{}'.format(node)] = ['node_{}'.format(child) for child in children]
+    fd, path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(graph, f)
+    del graph
+
+    def load_networkx():
+        g = nx.DiGraph()
+        for node, children in json.load(open(path, 'r')).items():
+            u = int(node.split('_')[1])
+            for child in children:
+                g.add_edge(int(child.split('_')[1]), u)
+        return g
+
+    def around_networkx(g, source, depth_limit):
+        visited = {source}
+        edges = []
+        stack = [(source, depth_limit, iter(g[source]))]
+        while stack:
+            parent, depth_now, children = stack[-1]
+            try:
+                child = next(children)
+                edges.append((parent, child))
+                if child not in visited:
+                    visited.add(child)
+                    if depth_now > 1:
+                        stack.append((child, depth_now - 1, iter(g[child])))
+            except StopIteration:
+                stack.pop()
+        return edges
+
+    try:
+        g, nx_time, nx_memory, nx_peak = measure(load_networkx)
+        top, csr_time, csr_memory, csr_peak = measure(lambda: Topology(path))
+    finally:
+        os.remove(path)
+
+    sources = rng.choice(top.nodes(), n_queries).tolist()
+    start = time.perf_counter()
+    expected = [around_networkx(g, source, 3) for source in sources]
+    nx_traversal = time.perf_counter() - start
+    start = time.perf_counter()
+    actual = [list(top.dfs(source, depth_limit=3)) for source in sources]
+    csr_traversal = time.perf_counter() - start
+    start = time.perf_counter()
+    for source in sources:
+        top.neighborhood(source, None, 3)
+    csr_neighborhood = time.perf_counter() - start
+
+    assert expected == actual, '两种拓扑存储方式的遍历结果不一致'
+    print('{}个节点，{}条边，{}次3跳遍历'.format(len(top), g.number_of_edges(), n_queries))
+    print('networkx: 加载 {:.2f}s，常驻内存 {:.1f}MB（峰值 {:.1f}MB），深度优先遍历 {:.3f}s'.format(
+        nx_time, nx_memory, nx_peak, nx_traversal))
+    print('CSR: 加载 {:.2f}s，常驻内存 {:.1f}MB（峰值 {:.1f}MB），深度优先遍历 {:.3f}s，按层展开 {:.3f}s'.format(
+        csr_time, csr_memory, csr_peak, csr_traversal, csr_neighborhood))
+
+
+def bench_stream(window_seconds=1800, locate_every=(1, 10, 100)):
+    """
+    将训练数据中的告警按时间顺序逐条送入流式推理，统计不同定位频率下每秒能处理的告警条数，
+    每次都从空的后验概率缓存开始，并校验最终的定位结果与对窗口内告警整体推理的结果一致
+    :param window_seconds: 滑动窗口的长度（秒）
+    :param locate_every: 每接收多少条告警定位一次
+    :return: 无
+    """
+
+    df = pd.concat([pd.read_csv('data/train/{}.csv'.format(i)) for i in range(100)], ignore_index=True)
+    df['timestamp'] = [parse_time(t) for t in df['time']]
+    df = df.sort_values('timestamp', kind='stable')
+    alarms = list(zip(df['triggername'], df['timestamp']))
+
+    for every in locate_every:
+        # 每次都重新加载模型，从空的后验概率缓存开始，避免后一次测量复用前一次的查询结果
+        tpl, top, re = ModelStore().load()
+        stream_infer = StreamingInfer(tpl, top, re, window_seconds)
+        start = time.perf_counter()
+        for i, (event, timestamp) in enumerate(alarms):
+            stream_infer.push(event, timestamp)
+            if i % every == every - 1:
+                stream_infer.locate()
+        actual = stream_infer.locate()
+        elapsed = time.perf_counter() - start
+        print('每{}条告警定位一次: {:.2f}s，{:.0f}条/秒'.format(every, elapsed, len(alarms) / elapsed))
+
+    window = df[df['timestamp'] > alarms[-1][1] - window_seconds].drop(columns='timestamp')
+    fd, path = tempfile.mkstemp(suffix='.csv')
+    os.close(fd)
+    try:
+        window.to_csv(path, index=False)
+        expected = Infer(tpl, top, re).infer(path)
+    finally:
+        os.remove(path)
+    assert (expected[0], expected[2:3]) == (actual[0], actual[2:3]), '流式推理与整体推理的结果不一致'
+
+
+def bench_dag(n_templates=2000, n_roots=200, sizes=(5000, 10000, 20000, 40000), record_size=20, threshold=3):
+    """
+    在随机生成的训练数据上，对比逐次判断路径是否存在与增量拓扑序两种构建根因推理图方式的耗时，并校验两者结果一致。
+    日志模板总数固定，训练数据逐渐增多：共现次数达到阈值的边越来越多，推理图中的路径越来越长。
+    只统计加边的耗时，两种方式统计共现次数的开销相同
+    :param n_templates: 日志模板个数
+    :param n_roots: 根因日志模板个数
+    :param sizes: 训练数据条数的列表
+    :param record_size: 每条训练数据中根因附近的日志模板个数
+    :param threshold: 加入边的共现次数阈值
+    :return: 无
+    """
+
+    rng = np.random.RandomState(0)
+    # 与实际数据相同，根因日志模板同时也是其他根因附近常见的日志模板
+    roots = rng.permutation(n_roots)
+    records = []
+    for i in range(max(sizes)):
+        root = roots[rng.randint(n_roots)]
+        # 根因附近的日志模板偏向于少数模板，使部分(根因, 模板)的共现次数达到阈值
+        data = rng.zipf(1.5, record_size) % n_templates
+        records.append((str(root), [str(template) for template in data]))
+    nodes = [str(template) for template in range(n_templates)]
+
+    def count_pairs(n_records):
+        # 原方式：共现次数每次达到或超过阈值时都尝试加边；增量方式：每一对只在恰好达到阈值时尝试一次
+        pair_counts = defaultdict(int)
+        every_time = []
+        once = []
+        for s, data in records[:n_records]:
+            for t in data:
+                if s == t:
+                    continue
+                pair_counts[s, t] += 1
+                if pair_counts[s, t] >= threshold:
+                    every_time.append((s, t))
+                if pair_counts[s, t] == threshold:
+                    once.append((s, t))
+        return every_time, once
+
+    def by_has_path(edges):
+        g = nx.DiGraph()
+        g.add_nodes_from(nodes)
+        for u, v in edges:
+            if not g.has_edge(u, v) and not nx.has_path(g, v, u):
+                g.add_edge(u, v)
+        return g
+
+    def by_topological_order(edges):
+        g = nx.DiGraph()
+        g.add_nodes_from(nodes)
+        order = TopologicalOrder(g)
+        for u, v in edges:
+            order.add_edge(u, v)
+        return g
+
+    print('日志模板: {}，根因日志模板: {}'.format(n_templates, n_roots))
+    for n_records in sizes:
+        every_time, once = count_pairs(n_records)
+
+        start = time.perf_counter()
+        expected = by_has_path(every_time)
+        path_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual = by_topological_order(once)
+        order_time = time.perf_counter() - start
+
+        assert set(expected.edges) == set(actual.edges), '根因推理图不一致'
+        print('训练数据: {}，边: {}，逐次判断路径: {:.3f}s，增量拓扑序: {:.3f}s（加速 {:.1f} 倍）'.format(
+            n_records, actual.number_of_edges(), path_time, order_time, path_time / order_time))
+
+
+def bench_candidates(n_nodes=20000, n_children=3, sizes=(100, 1000, 5000), logs_per_node=5, jumps=2):
+    """
+    在随机生成的拓扑和告警上，对比逐个节点展开邻域与稀疏矩阵批量计算两种收集候选证据（证据日志模板集合、证据频率之和）方式的耗时，
+    并校验两者结果一致
+    :param n_nodes: 拓扑的节点个数
+    :param n_children: 每个节点的子节点个数
+    :param sizes: 一次事件中发生告警的节点个数
+    :param logs_per_node: 每个告警节点上的告警条数
+    :param jumps: 聚类的跳数
+    :return: 无
+    """
+
+    ts = TemplateScanner('data/test')
+    templates = [index for message, index in ts.get_templates() if ts.get_freq(index) <= Clustering.freq_threshold]
+    messages = [ts.get_message_by_template(index) for index in templates]
+    rng = np.random.RandomState(0)
+    graph = {}
+    for node in range(n_nodes):
+        children = rng.randint(node + 1, min(node + 50, n_nodes - 1) + 1, n_children) if node + 1 < n_nodes else []
+        graph['node_{}'.format(node)] = ['node_{}'.format(child) for child in children]
+    fd, path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(graph, f)
+    try:
+        top = Topology(path)
+    finally:
+        os.remove(path)
+
+    def by_neighborhood(cl):
+        mapping = cl.get_node_to_log_mapping()
+        result = {}
+        for node in mapping:
+            evidence_nodes = set(cl.cluster_by_topology(node, jumps=jumps).nodes)
+            evidence_nodes.remove(node)
+            if evidence_nodes:
+                evidence = {log.template for evidence_node in evidence_nodes for log in mapping[evidence_node]}
+                result[node] = (evidence, sum(cl.get_event_freq(log)
+                                              for evidence_node in evidence_nodes for log in mapping[evidence_node]))
+        return result
+
+    def by_matrix(cl):
+        nodes = list(cl.get_node_to_log_mapping())
+        node_templates, incidence, counts, n_events = cl.get_node_features()
+        reach = top.reachability(nodes, jumps)
+        evidence_templates = (reach @ incidence).tocsr()
+        evidence_counts = reach @ counts
+        return {node: (set(node_templates[evidence_templates.indices[evidence_templates.indptr[i]:
+                                                                     evidence_templates.indptr[i + 1]]].tolist()),
+                       int(evidence_counts[i]) / n_events)
+                for i, node in enumerate(nodes) if reach.indptr[i] < reach.indptr[i + 1]}
+
+    for size in sizes:
+        # 告警节点集中在拓扑的一段范围内，使它们之间相互连通
+        start = rng.randint(0, n_nodes - 2 * size)
+        alarmed = rng.choice(np.arange(start, start + 2 * size), size, replace=False)
+        nodes = np.repeat(alarmed, logs_per_node)
+        template_ids = rng.randint(0, len(templates), len(nodes))
+        logs = LogBatch(nodes, np.array(templates)[template_ids], template_ids, messages)
+        cl = Clustering(ts, top, logs)
+
+        expected, neighborhood_time = clock(lambda: by_neighborhood(cl))
+        actual, matrix_time = clock(lambda: by_matrix(cl))
+
+        assert expected.keys() == actual.keys() and all(
+            expected[node][0] == actual[node][0] and np.isclose(expected[node][1], actual[node][1])
+            for node in expected), '候选证据不一致'
+        print('{}个告警节点: 逐个展开邻域 {:.3f}s，稀疏矩阵 {:.3f}s（加速 {:.1f} 倍）'.format(
+            size, neighborhood_time, matrix_time, neighborhood_time / matrix_time))
+
+
+BENCHMARKS = {
+    'template': bench_template_matching,
+    'ingest': bench_ingest,
+    'clustering': bench_clustering,
+    'topology': bench_topology,
+    'stream': bench_stream,
+    'dag': bench_dag,
+    'candidates': bench_candidates,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        print('== {} =='.format(name))
+        BENCHMARKS[name]()
@@ -0,0 +1,88 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    线程安全的LRU缓存
+    容量达到上限后淘汰最久未被访问的条目，并统计命中与未命中次数
+    """
+
+    def __init__(self, capacity):
+        """
+        构造函数
+        :param capacity: 缓存条目数的上限，为0时不缓存任何条目
+        """
+
+        self._capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """
+        查询缓存，命中时将该条目标记为最近访问
+        :param key: 键
+        :param default: 未命中时的返回值
+        :return: 缓存的值，未命中时返回default
+        """
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """
+        写入缓存，超出容量时淘汰最久未被访问的条目
+        :param key: 键
+        :param value: 值
+        :return: 无
+        """
+
+        if self._capacity <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._capacity:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        清空缓存（命中统计一并清零）
+        :return: 无
+        """
+
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """
+        获取缓存的统计信息
+        :return: dict，包含hits，misses，size，capacity
+        """
+
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'capacity': self._capacity
+            }
+
+    def __getstate__(self):
+        # 锁无法序列化，传递到其他进程时只保留容量，缓存内容在新进程中重新积累
+        return {'capacity': self._capacity}
+
+    def __setstate__(self, state):
+        self.__init__(state['capacity'])
+
+    def __len__(self):
+        return len(self._entries)
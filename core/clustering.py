@@ -1,9 +1,59 @@
-from collections import defaultdict
-from copy import deepcopy
+import logging
+from collections import Counter
+from collections.abc import Mapping
 
-from core.scanner import TemplateScanner
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from core.log import fields
+from core.metrics import timed
+from core.scanner import NO_TEMPLATE, LogBatch, TemplateScanner
 from core.topology import Topology
 
+logger = logging.getLogger(__name__)
+
+
+class EventGroups(Mapping):
+    """
+    节点 -> 事件 的只读映射
+    所有事件按节点分组连续存放在一个列表中，各节点的事件范围由偏移数组给出（与拓扑的CSR结构相同），
+    不为每个节点单独保存一个列表；节点按其事件首次出现的顺序排列
+    """
+
+    def __init__(self, nodes, indptr, events):
+        """
+        构造函数
+        :param nodes: 节点列表
+        :param indptr: 偏移数组，第i个节点的事件为events[indptr[i]:indptr[i + 1]]
+        :param events: 按节点分组排列的LogEvent列表
+        """
+
+        self._nodes = nodes
+        self._positions = {node: i for i, node in enumerate(nodes)}
+        self._indptr = indptr
+        self._events = events
+
+    def __getitem__(self, node):
+        i = self._positions[node]
+        return self._events[self._indptr[i]:self._indptr[i + 1]]
+
+    def __contains__(self, node):
+        return node in self._positions
+
+    def __iter__(self):
+        return iter(self._nodes)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def events(self):
+        """
+        获取按节点分组排列的所有事件
+        :return: LogEvent列表
+        """
+        return self._events
+
 
 class Clustering:
     """
@@ -13,24 +63,29 @@ class Clustering:
     # 频率过滤阈值
     freq_threshold = 0.07
 
-    def __init__(self, template_scanner: TemplateScanner, top: Topology, get_root_cause_only=False):
+    def __init__(self, template_scanner: TemplateScanner, top: Topology, logs: LogBatch, get_root_cause_only=False):
         """
         构造函数，初始化相关成员变量，并进行过滤高频项、重复项聚类等基本处理
         :param template_scanner: 日志模板扫描器
         :param top: 拓扑图
+        :param logs: 本次需要聚类的结构化日志，由TemplateScanner.parse得到
         :param get_root_cause_only: 是否仅用于获取根因
         """
 
         self._template_scanner: TemplateScanner = template_scanner
-        self._clustered_logs = deepcopy(self._template_scanner.get_logs())
+        self._logs = logs
+        # 聚类过程中只维护日志在LogBatch中的下标，不复制日志本身
+        self._clustered_logs = np.arange(len(logs))
         self._top = top
-        self._event_freq = defaultdict(int)
+        self._event_counts = {}
+        self._n_events = 0
+        self._alarmed_mask = None
 
         self._root_cause = None
-        for log in self._clustered_logs:
-            if 'is_root' in log and log['is_root']:
-                self._root_cause = log
-                break
+        if logs.is_root is not None:
+            roots = np.flatnonzero(logs.is_root)
+            if len(roots) > 0:
+                self._root_cause = logs.get_log(roots[0])
 
         if get_root_cause_only:
             return
@@ -38,9 +93,7 @@ class Clustering:
         self._remove_high_freq()
         self._remove_duplicate()
 
-        self._node_to_log_mapping = defaultdict(list)
-        for log in self._clustered_logs:
-            self._node_to_log_mapping[log['node']].append(log)
+        self._group_by_node()
 
     def get_event_freq(self, log):
         """
@@ -49,12 +102,12 @@ class Clustering:
         :return: 发生频率
         """
 
-        node = log['node']
-        template = log['template']
-        print(log['node'], log['message'], log['template'], self._event_freq[(log['node'], log['template'])])
-        if (node, template) not in self._event_freq:
-            return 0
-        return self._event_freq[(node, template)]
+        count = self._event_counts.get((log.node, log.template), 0)
+        freq = count / self._n_events if count else 0
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('event freq', extra=fields(node=log.node, template=log.template, message=log.message,
+                                                    freq=freq))
+        return freq
 
     def get_root_cause(self):
         """
@@ -63,38 +116,97 @@ class Clustering:
         """
         return self._root_cause
 
-    def cluster_by_topology(self, node, extra=lambda u, v: True, jumps=2):
+    @timed('cluster_by_topology')
+    def cluster_by_topology(self, node, extra=None, jumps=2):
         """
         基于拓扑图进行聚类
         :param node: 节点
-        :param extra: 搜索的附加条件
+        :param extra: 搜索的附加条件，lambda u, v返回True或False，为None时不附加条件
         :param jumps: 聚类的跳数
         :return: 子图，节点附近跳树范围之内且存在事件发生的节点和边构成的子图
         """
+
+        if extra is None:
+            if self._alarmed_mask is None:
+                self._alarmed_mask = self._top.node_mask(self._node_to_log_mapping)
+            return self._top.neighborhood(node, self._alarmed_mask, jumps)
         return self._top.subgraph_around(node, lambda u, v: v in self._node_to_log_mapping and extra(u, v), jumps)
 
-    def get_node_to_log_mapping(self) -> dict:
+    def get_node_to_log_mapping(self) -> EventGroups:
         """
-        获取一个dict：节点 -> 事件
-        :return: dict：节点 -> 事件
+        获取节点 -> 事件 的映射
+        :return: EventGroups：节点 -> 事件（LogEvent列表）
         """
         return self._node_to_log_mapping
 
-    def _remove_duplicate(self):
-        result = []
-        l = len(self._clustered_logs)
-        for log in self._clustered_logs:
-            self._event_freq[(log['node'], log['template'])] += 1
-            if log not in result:
-                result.append(log)
-        self._event_freq = {k: v / l for k, v in self._event_freq.items()}
-        self._clustered_logs = result
+    def get_node_features(self):
+        """
+        获取各节点的事件特征，节点按get_node_to_log_mapping的顺序排列，用于对所有节点批量计算证据
+        :return: 元组(日志模板分类ID数组, 节点-日志模板关联矩阵, 各节点事件的出现次数之和, 日志总条数)，
+                 关联矩阵为scipy稀疏矩阵（CSR），第i行第j列非零表示第i个节点上发生了第j个日志模板的事件；
+                 事件频率 = 出现次数 / 日志总条数
+        """
 
+        events = self._node_to_log_mapping.events()
+        groups = np.repeat(np.arange(len(self._node_to_log_mapping)), np.diff(self._group_indptr))
+        templates, columns = np.unique(np.array([log.template for log in events], dtype=np.int64),
+                                       return_inverse=True)
+        incidence = sparse.csr_matrix((np.ones(len(events), dtype=np.int32), (groups, columns.reshape(-1))),
+                                      shape=(len(self._node_to_log_mapping), len(templates)))
+        counts = np.bincount(groups, weights=[self._event_counts[(log.node, log.template)] for log in events],
+                             minlength=len(self._node_to_log_mapping))
+        return templates, incidence, counts.astype(np.int64), self._n_events
+
+    def _group_by_node(self):
+        # 按节点首次出现的顺序稳定排序，得到分组连续的事件以及各节点的偏移
+        index = self._clustered_logs
+        node_ids, first_seen, inverse = np.unique(self._logs.nodes[index], return_index=True, return_inverse=True)
+        order = np.argsort(first_seen, kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        groups = rank[inverse.reshape(-1)]
+        self._group_indptr = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(groups, minlength=len(order)), out=self._group_indptr[1:])
+        events = [self._logs.get_log(i) for i in index[np.argsort(groups, kind='stable')].tolist()]
+        self._node_to_log_mapping = EventGroups(node_ids[order].tolist(), self._group_indptr.tolist(), events)
+
+    @timed('remove_duplicate')
+    def _remove_duplicate(self):
+        logs = self._logs
+        index = self._clustered_logs
+        events = pd.DataFrame({
+            'node': logs.nodes[index],
+            'template': logs.templates[index],
+            'message': logs.message_ids[index]
+        })
+        if logs.is_root is not None:
+            events['is_root'] = logs.is_root[index]
+
+        self._n_events = len(index)
+        counts = events.groupby(['node', 'template'], sort=False).size()
+        self._event_counts = {(int(node), int(template)): int(times) for (node, template), times in counts.items()}
+        self._clustered_logs = index[~events.duplicated().to_numpy()]
+
+    @timed('remove_high_freq')
     def _remove_high_freq(self):
-        result = []
-        for log in self._clustered_logs:
-            if self._template_scanner.get_freq(log['template']) <= self.freq_threshold:
-                result.append(log)
-                continue
-            print('Removed {}'.format(log['message']))
-        self._clustered_logs = result
+        logs = self._logs
+        templates = logs.templates[self._clustered_logs]
+        # 未能匹配日志模板的日志（不在线学习模板时）无法参与推理，一并过滤
+        removed = {template for template in np.unique(templates).tolist()
+                   if template == NO_TEMPLATE or self._template_scanner.get_freq(template) > self.freq_threshold}
+        if not removed:
+            return
+
+        is_removed = np.isin(templates, list(removed))
+        if logger.isEnabledFor(logging.DEBUG):
+            # 按模板汇总，每个被过滤的模板只记录一条（附一条示例日志）
+            examples = {}
+            counts = Counter()
+            for i in self._clustered_logs[is_removed].tolist():
+                template = int(logs.templates[i])
+                examples.setdefault(template, logs.messages[logs.message_ids[i]])
+                counts[template] += 1
+            for template, count in counts.items():
+                logger.debug('removed high frequency template',
+                             extra=fields(template=template, count=count, example=examples[template]))
+        self._clustered_logs = self._clustered_logs[~is_removed]
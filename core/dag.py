@@ -0,0 +1,88 @@
+import networkx as nx
+
+
+class TopologicalOrder:
+    """
+    有向无环图的增量拓扑序（Pearce–Kelly算法）
+    维护图中所有节点的一个拓扑序，加边时若起点已排在终点之前则无需任何搜索；
+    否则只在两者之间的区间内分别向前、向后搜索受影响的节点，若向前搜索到达起点则说明会形成环，拒绝加入，
+    否则只重新分配这些节点的序号。与每加一条边都从头判断路径是否存在相比，搜索范围只限于序号区间内的节点
+    """
+
+    def __init__(self, g: nx.DiGraph, order=None):
+        """
+        构造函数
+        :param g: 有向无环图，之后通过add_edge加边
+        :param order: 拓扑序（节点列表），为None时根据图计算
+        """
+
+        self._g = g
+        self._nodes = list(nx.topological_sort(g)) if order is None else list(order)
+        self._positions = {node: i for i, node in enumerate(self._nodes)}
+        # 搜索时使用的邻接表（不经过networkx的视图对象）
+        self._succ = {node: list(g.successors(node)) for node in g.nodes}
+        self._pred = {node: list(g.predecessors(node)) for node in g.nodes}
+
+    def copy(self, g: nx.DiGraph):
+        """
+        复制拓扑序，用于图的副本
+        :param g: 图的副本，与当前图的节点和边相同
+        :return: TopologicalOrder
+        """
+        return TopologicalOrder(g, self._nodes)
+
+    def add_edge(self, u, v):
+        """
+        加入一条边，不存在的节点会自动加入并排在最后
+        :param u: 起点
+        :param v: 终点
+        :return: 是否加入（边已存在或会形成环时不加入）
+        """
+
+        for node in (u, v):
+            if node not in self._positions:
+                self._positions[node] = len(self._nodes)
+                self._nodes.append(node)
+                self._succ[node] = []
+                self._pred[node] = []
+                self._g.add_node(node)
+        if self._g.has_edge(u, v) or u == v:
+            return False
+
+        lower = self._positions[v]
+        upper = self._positions[u]
+        if lower < upper:
+            forward = self._search(v, self._succ, lower, upper, u)
+            if forward is None:
+                return False
+            backward = self._search(u, self._pred, lower, upper, None)
+            self._reorder(backward, forward)
+
+        self._g.add_edge(u, v)
+        self._succ[u].append(v)
+        self._pred[v].append(u)
+        return True
+
+    def _search(self, start, adjacency, lower, upper, target):
+        # 在序号区间(lower, upper)内搜索从start沿adjacency可以到达的节点，到达target时返回None
+        positions = self._positions
+        visited = {start}
+        stack = [start]
+        while stack:
+            node = stack.pop()
+            for neighbor in adjacency[node]:
+                if neighbor == target:
+                    return None
+                if neighbor not in visited and lower < positions[neighbor] < upper:
+                    visited.add(neighbor)
+                    stack.append(neighbor)
+        return visited
+
+    def _reorder(self, backward, forward):
+        # 受影响节点原有的序号重新分配：能到达起点的节点整体排在终点能到达的节点之前，各自保持原有的相对顺序
+        key = self._positions.__getitem__
+        nodes = sorted(backward, key=key) + sorted(forward, key=key)
+        positions = sorted(self._positions[node] for node in nodes)
+        for node, position in zip(nodes, positions):
+            self._positions[node] = position
+            self._nodes[position] = node
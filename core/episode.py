@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse.csgraph import connected_components
+
+from core.clustering import Clustering
+from core.metrics import timed
+from core.scanner import NO_TEMPLATE, LogBatch, TemplateScanner
+from core.topology import Topology
+
+
+class Episode:
+    """
+    事件片段
+    一个告警文件（例如一整天的告警导出）中时间上连续、拓扑上相互连通的一段告警，作为一个独立的事件进行推理
+    """
+
+    def __init__(self, logs: LogBatch):
+        """
+        构造函数
+        :param logs: 该片段的告警（按时间排列）
+        """
+
+        self.logs = logs
+        self.start = _format_time(logs.times[0])
+        self.end = _format_time(logs.times[-1])
+        # 推理结果（同Infer.infer）以及根因候选的排名（(节点, 根因告警信息, 得分)列表），推理后设置
+        self.result = None
+        self.ranking = None
+
+    def __len__(self):
+        return len(self.logs)
+
+
+@timed('segment')
+def segment(tpl: TemplateScanner, top: Topology, logs: LogBatch, gap_seconds, jumps):
+    """
+    将告警切分为事件片段：先按时间排序，相邻两条告警的间隔超过gap_seconds时切开；
+    每一段内再按拓扑连通性切分，只经过发生告警的节点、跳数在jumps之内能够相互到达的节点属于同一片段。
+    高频告警和未能匹配日志模板的告警在聚类时会被过滤，不参与切分。jumps与聚类的跳数一致时，每个节点在片段内收集到的证据与整体推理时相同
+    :param tpl: 日志模板扫描器
+    :param top: 拓扑图
+    :param logs: 带告警时间的结构化日志，由TemplateScanner.parse(..., with_time=True)得到
+    :param gap_seconds: 切分的时间间隔（秒）
+    :param jumps: 拓扑连通的跳数
+    :return: Episode列表，按开始时间排列
+    """
+
+    templates, inverse = np.unique(logs.templates, return_inverse=True)
+    is_kept = np.array([template != NO_TEMPLATE and tpl.get_freq(template) <= Clustering.freq_threshold
+                        for template in templates.tolist()], dtype=bool)
+    kept = np.flatnonzero(is_kept[inverse.reshape(-1)])
+    order = kept[np.argsort(logs.times[kept], kind='stable')]
+    times = logs.times[order]
+    breaks = np.flatnonzero(np.diff(times) > np.timedelta64(int(gap_seconds * 1000), 'ms')) + 1
+
+    episodes = []
+    for part in np.split(order, breaks):
+        if len(part) == 0:
+            continue
+        nodes, node_index = np.unique(logs.nodes[part], return_inverse=True)
+        reach = top.reachability(nodes, jumps)
+        n_components, labels = connected_components(reach, directed=True, connection='weak')
+        components = labels[node_index.reshape(-1)]
+        # 各片段内保持时间顺序
+        by_component = np.argsort(components, kind='stable')
+        bounds = np.flatnonzero(np.diff(components[by_component])) + 1
+        for indices in np.split(part[by_component], bounds):
+            episodes.append(Episode(logs.take(indices)))
+    # 片段按其第一条告警的时间排列
+    episodes.sort(key=lambda episode: episode.logs.times[0])
+    return episodes
+
+
+def _format_time(value):
+    return pd.Timestamp(value).strftime('%Y-%m-%d %H:%M:%S')
@@ -1,86 +1,201 @@
-from datetime import datetime
+import itertools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
 
 from core.clustering import Clustering
+from core.episode import Episode, segment
+from core.log import fields
+from core.metrics import timed
 from core.relationship import Relationship
-from core.scanner import TemplateScanner
-from core.topology import Topology
+from core.scanner import LogBatch, TemplateScanner
+from core.topology import NO_SYSTEM, SystemTopology, Topology
+
+logger = logging.getLogger(__name__)
 
 
 class Infer:
     """
     最终的推理实现类
+    每次推理的中间状态（结构化日志、聚类结果）只存在于infer调用内部，
+    模板、拓扑图、根因推理图在各次推理之间共享且只读，因此可以被多个线程同时调用
     """
 
-    def __init__(self, tpl: TemplateScanner, top: Topology, re: Relationship):
+    # 聚类（收集证据）的跳数
+    cluster_jumps = 2
+    # 输出根因附近局部拓扑的跳数
+    around_jumps = 3
+    # 候选得分低于该值时不作为根因候选
+    min_score = 0.01
+    # 批量推理时并行推理的线程数
+    batch_workers = 4
+    # 层级定位时，只在得分最高的若干个系统中寻找根因候选
+    top_systems = 3
+    # 层级定位时，候选所在系统沿系统级拓扑该跳数之内的系统（直接依赖）中的告警也作为证据
+    system_jumps = 1
+    # 切分事件片段时，相邻两条告警的间隔超过该值（秒）则属于不同的片段
+    episode_gap_seconds = 120
+    # 每个事件片段输出的根因候选个数
+    ranking_size = 5
+
+    def __init__(self, tpl: TemplateScanner, top: Topology, re: Relationship, systems: SystemTopology = None):
         """
         构造方法，初始化
         :param tpl: 模板扫描器
         :param top: 拓扑图
         :param re: 根因推理图
+        :param systems: 系统级拓扑，不为None时进行层级定位：先按系统聚合告警对系统排序，
+                        再只在得分最高的系统及其直接依赖的系统内进行节点级的聚类和打分
         """
         self._tpl = tpl
         self._top = top
         self._re = re
+        self._systems = systems
+
+    def infer_many(self, sources, max_workers=None):
+        """
+        批量推理，多个文件在线程池中并行推理，共享模板匹配缓存和后验概率缓存
+        :param sources: 可迭代对象，元素为(名称, csv文件路径/内容/文件对象)
+        :param max_workers: 并行推理的线程数，为None时使用类属性batch_workers
+        :return: 一个Python Generator，按完成的先后顺序产出(名称, 推理结果, 异常)，推理成功时异常为None，失败时推理结果为None
+        """
+
+        max_workers = self.batch_workers if max_workers is None else max_workers
+        with ThreadPoolExecutor(max_workers) as executor:
+            # 同时提交的文件数有上限，文件很多时不会一次性把所有文件都读入内存
+            max_in_flight = 2 * max_workers
+            sources = iter(sources)
+            running = {}
+            while True:
+                for name, source in itertools.islice(sources, max_in_flight - len(running)):
+                    running[executor.submit(self.infer, source)] = name
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    error = future.exception()
+                    yield name, (None if error is not None else future.result()), error
+
+    def infer_episodes(self, path, max_workers=None):
+        """
+        将一个告警文件（例如一整天的告警导出）按时间间隔和拓扑连通性切分为多个事件片段，各片段分别并行推理
+        :param path: csv文件路径，也可以是csv文件内容（bytes）或文件对象，需要包含time列
+        :param max_workers: 并行推理的线程数，为None时使用类属性batch_workers
+        :return: Episode列表，按开始时间排列；每个片段的result为推理结果（同infer），ranking为根因候选的排名
+        """
 
+        logs = self._tpl.parse(path, with_time=True)
+        episodes = segment(self._tpl, self._top, logs, self.episode_gap_seconds, self.cluster_jumps)
+        with ThreadPoolExecutor(self.batch_workers if max_workers is None else max_workers) as executor:
+            list(executor.map(self._infer_episode, episodes))
+        return episodes
+
+    @timed('infer')
     def infer(self, path):
         """
         进行推理
-        :param path: csv文件路径
+        :param path: csv文件路径，也可以是csv文件内容（bytes）或文件对象
         :return: 推理结果，一个元组(节点, 根因告警信息, 节点的局部拓扑子图)
         """
 
-        start_time = datetime.now()
+        start_time = time.perf_counter()
+        cl, result = self._rank(self._tpl.parse(path))
+        return self._result(cl, result, start_time)
+
+    def _infer_episode(self, episode: Episode):
+        start_time = time.perf_counter()
+        cl, result = self._rank(episode.logs)
+        episode.result = self._result(cl, result, start_time)
+        episode.ranking = [(node, root_log.message, score * phi)
+                           for node, phi, root_log, score in result[:self.ranking_size]]
 
-        self._tpl.init(path)
-        cl = Clustering(self._tpl, self._top)
+    def _rank(self, logs: LogBatch):
+        # 聚类并对所有根因候选打分排序，返回聚类结果和按得分从高到低排列的(节点, 后验概率, 根因事件, 得分)列表
+        with timed('clustering'):
+            cl = Clustering(self._tpl, self._top, logs)
         mapping = cl.get_node_to_log_mapping()
-        result = []
-        for node, root_logs in mapping.items():
-            evidence_nodes = set()
-            for around in cl.cluster_by_topology(node).nodes:
-                evidence_nodes.add(around)
-            evidence_nodes.remove(node)
-
-            if len(evidence_nodes) == 0:
-                continue
-
-            tot_freq = 0
-            evidence = set()
-            for evidence_node in evidence_nodes:
-                for log in mapping.get(evidence_node):
-                    evidence.add(log['template'])
-                    tot_freq += cl.get_event_freq(log)
-
-            for root_log in root_logs:
-                if root_log['template'] not in (
-                        2,
-                        9,
-                        3,
-                        21,
-                        0,
-                        22,
-                        14,
-                        10,
-                        19
-                ):
-                    continue
-                freq = cl.get_event_freq(root_log)
-                if (tot_freq + freq) * freq < 0.01:
+        with timed('collect_candidates'):
+            root_templates = self._re.get_root_templates()
+            candidates = []
+            # 所有节点的证据一次性计算：可达矩阵 × 节点-日志模板关联矩阵得到各节点的证据日志模板，
+            # 可达矩阵 × 各节点事件的出现次数得到各节点证据的频率之和
+            nodes = list(mapping)
+            templates, incidence, counts, n_events = cl.get_node_features()
+            searched = None
+            if self._systems is not None:
+                with timed('rank_systems'):
+                    kept, searched = self._select_systems(nodes, templates, incidence, counts, root_templates)
+                nodes = [nodes[i] for i in kept.tolist()]
+                incidence = incidence[kept]
+                counts = counts[kept]
+            reach = self._top.reachability(nodes, self.cluster_jumps)
+            evidence_templates = (reach @ incidence).tocsr()
+            evidence_counts = reach @ counts
+            for i, node in enumerate(nodes):
+                if reach.indptr[i] == reach.indptr[i + 1] or (searched is not None and not searched[i]):
                     continue
-                print('rca ', root_log['node'], tot_freq + cl.get_event_freq(root_log))
-                evidence_query = evidence - {root_log['template']}
-                phi = self._re.get_possibility_when(evidence_query, root_log['template'])
-                result.append((node, phi.values[1], root_log, list(evidence_nodes), (tot_freq + freq) * freq))
 
-        result.sort(key=lambda x: x[4] * x[1], reverse=True)
+                tot_freq = int(evidence_counts[i]) / n_events
+                evidence = set(templates[evidence_templates.indices[evidence_templates.indptr[i]:
+                                                                    evidence_templates.indptr[i + 1]]].tolist())
 
-        if len(result) == 0:
-            end_time = datetime.now()
-            return None, (1000 * (end_time - start_time).total_seconds())
+                for root_log in mapping[node]:
+                    if root_log.template not in root_templates:
+                        continue
+                    freq = cl.get_event_freq(root_log)
+                    if (tot_freq + freq) * freq < self.min_score:
+                        continue
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug('candidate', extra=fields(node=root_log.node, template=root_log.template,
+                                                               freq=tot_freq + freq))
+                    evidence_query = evidence - {root_log.template}
+                    candidates.append((node, root_log, evidence_query, (tot_freq + freq) * freq))
+
+        # 所有候选的后验概率一次性批量计算
+        phis = self._re.get_possibilities_when([(root_log.template, evidence_query)
+                                                for node, root_log, evidence_query, score in candidates])
+        with timed('rank_candidates'):
+            result = []
+            for (node, root_log, evidence_query, score), phi in zip(candidates, phis):
+                result.append((node, phi, root_log, score))
 
-        around = cl.cluster_by_topology(result[0][0], lambda u, v: True, 3)
+            result.sort(key=lambda x: x[3] * x[1], reverse=True)
+        return cl, result
 
-        end_time = datetime.now()
+    def _result(self, cl, result, start_time):
+        if len(result) == 0:
+            return None, 1000 * (time.perf_counter() - start_time)
+
+        around = cl.cluster_by_topology(result[0][0], jumps=self.around_jumps)
+        mapping = cl.get_node_to_log_mapping()
 
-        return result[0][0], (1000 * (end_time - start_time).total_seconds()), result[0][2]['message'], around,\
+        return result[0][0], 1000 * (time.perf_counter() - start_time), result[0][2].message, around,\
                {v: mapping[v] for v in around.nodes}
+
+    def _select_systems(self, nodes, templates, incidence, counts, root_templates):
+        # 按系统聚合告警：系统的得分与节点级候选的得分规则相同，以系统内告警的出现次数为自身频率，
+        # 以系统级拓扑跳数范围之内其他发生告警的系统的出现次数之和为证据频率；没有可作为根因的告警的系统不参与排序。
+        # 返回保留的节点（得分最高的系统及其直接依赖的系统中的节点）的下标，以及其中哪些节点需要寻找根因候选
+        node_systems = self._systems.system_of(nodes)
+        has_root = np.asarray(incidence[:, np.isin(templates, list(root_templates))].sum(axis=1)).reshape(-1) > 0
+        known = node_systems != NO_SYSTEM
+        systems, first_seen, inverse = np.unique(node_systems[known], return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        system_counts = np.bincount(inverse, weights=counts[known], minlength=len(systems))
+        system_has_root = np.bincount(inverse, weights=has_root[known], minlength=len(systems)) > 0
+        reach = self._systems.graph.reachability(systems, self.system_jumps)
+        scores = (reach @ system_counts + system_counts) * system_counts
+        scores[~system_has_root] = -1
+        # 得分相同时按系统中的告警首次出现的先后排列
+        ranked = np.lexsort((first_seen, -scores))[:self.top_systems]
+        top = systems[ranked[system_has_root[ranked]]]
+        allowed = set(top.tolist())
+        for system in top.tolist():
+            allowed.update(self._systems.graph.neighborhood(system, None, self.system_jumps).nodes)
+
+        kept = np.flatnonzero(~known | np.isin(node_systems, list(allowed)))
+        searched = ~known[kept] | np.isin(node_systems[kept], top)
+        return kept, searched
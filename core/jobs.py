@@ -0,0 +1,151 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobQueueFull(Exception):
+    """
+    排队的任务数已达上限，拒绝提交新的任务
+    """
+
+
+class Job:
+    """
+    异步任务，记录任务的状态（pending，running，done，failed）以及结果或错误信息
+    """
+
+    def __init__(self, job_id):
+        """
+        构造函数
+        :param job_id: 任务ID
+        """
+
+        self.job_id = job_id
+        self.status = 'pending'
+        self.result = None
+        self.error = None
+        self.finished_at = None
+        self._finished = threading.Event()
+
+    def wait(self, timeout=None):
+        """
+        等待任务结束
+        :param timeout: 最长等待时间（秒），为None时一直等待
+        :return: 任务是否已经结束
+        """
+        return self._finished.wait(timeout)
+
+    def to_dict(self):
+        """
+        将任务状态构造成dict
+        :return: dict，包含job_id，status，以及（如果已经结束）result或error
+        """
+
+        job = {
+            'job_id': self.job_id,
+            'status': self.status
+        }
+        if self.status == 'done':
+            job['result'] = self.result
+        elif self.status == 'failed':
+            job['error'] = self.error
+        return job
+
+    def finish(self, status, result=None, error=None):
+        """
+        结束任务
+        :param status: 结束状态，done或failed
+        :param result: 任务结果
+        :param error: 错误信息
+        :return: 无
+        """
+
+        self.result = result
+        self.error = error
+        self.finished_at = time.monotonic()
+        self.status = status
+        self._finished.set()
+
+
+class JobQueue:
+    """
+    异步任务队列
+    任务在固定大小的线程池中执行，同时执行的任务数和排队的任务数都有上限，
+    突发的大量提交不会占满请求处理线程，超过上限时直接拒绝；已结束任务的结果保留一段时间供查询
+    """
+
+    # 同时执行的任务数
+    max_workers = 2
+    # 未结束（排队及执行中）的任务数上限
+    max_pending = 64
+    # 已结束任务的结果保留时间（秒）
+    result_ttl = 600
+
+    def __init__(self, max_workers=None, max_pending=None):
+        """
+        构造函数
+        :param max_workers: 同时执行的任务数，为None时使用类属性max_workers
+        :param max_pending: 未结束的任务数上限，为None时使用类属性max_pending
+        """
+
+        self._max_pending = self.max_pending if max_pending is None else max_pending
+        self._executor = ThreadPoolExecutor(self.max_workers if max_workers is None else max_workers)
+        self._jobs = {}
+        self._n_pending = 0
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args):
+        """
+        提交任务
+        :param func: 任务函数，返回值作为任务结果
+        :param args: 任务函数的参数
+        :return: Job
+        """
+
+        with self._lock:
+            self._purge()
+            if self._n_pending >= self._max_pending:
+                raise JobQueueFull('排队的任务数已达上限{}'.format(self._max_pending))
+            job = Job(uuid.uuid4().hex)
+            self._jobs[job.job_id] = job
+            self._n_pending += 1
+        self._executor.submit(self._run, job, func, args)
+        return job
+
+    def get(self, job_id):
+        """
+        查询任务
+        :param job_id: 任务ID
+        :return: Job，任务不存在（或结果已过期）时返回None
+        """
+
+        with self._lock:
+            self._purge()
+            return self._jobs.get(job_id)
+
+    def shutdown(self):
+        """
+        等待已提交的任务执行完毕并关闭线程池
+        :return: 无
+        """
+        self._executor.shutdown()
+
+    def _run(self, job, func, args):
+        job.status = 'running'
+        try:
+            result = func(*args)
+        except Exception as e:
+            job.finish('failed', error='{}: {}'.format(type(e).__name__, e))
+        else:
+            job.finish('done', result=result)
+        finally:
+            with self._lock:
+                self._n_pending -= 1
+
+    def _purge(self):
+        expired_before = time.monotonic() - self.result_ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and job.finished_at < expired_before]
+        for job_id in expired:
+            del self._jobs[job_id]
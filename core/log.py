@@ -0,0 +1,82 @@
+import json
+import logging
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+# core包内所有模块的日志记录器的上级记录器名，各模块通过logging.getLogger(__name__)获取记录器
+LOGGER_NAME = 'core'
+
+
+def fields(**kwargs):
+    """
+    构造结构化日志的字段，作为日志调用的extra参数：logger.debug('...', extra=fields(node=1))
+    :param kwargs: 字段名 -> 字段值
+    :return: dict
+    """
+    return {'fields': kwargs}
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    结构化日志格式：时间 级别 记录器 消息 字段名=字段值 ...，字段值按JSON编码
+    """
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        record_fields = getattr(record, 'fields', None)
+        if record_fields:
+            line += ' ' + ' '.join('{}={}'.format(name, json.dumps(value, ensure_ascii=False, default=str))
+                                   for name, value in record_fields.items())
+        return line
+
+
+class SamplingFilter(logging.Filter):
+    """
+    按比例抽样DEBUG级别的日志，INFO及以上级别的日志全部保留
+    """
+
+    def __init__(self, rate):
+        """
+        构造函数
+        :param rate: DEBUG日志的保留比例，0到1之间
+        """
+
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+
+def configure_logging(level='INFO', debug_sample_rate=1.0, stream=None):
+    """
+    配置core包的日志：日志记录先放入队列，由后台线程格式化并写出，记录日志的线程不会因为写出而阻塞
+    未调用时沿用logging的默认行为（只输出WARNING及以上级别），DEBUG日志在未开启时只有一次级别判断的开销
+    :param level: 日志级别
+    :param debug_sample_rate: DEBUG日志的保留比例
+    :param stream: 写出的目标，为None时为标准错误
+    :return: QueueListener，程序退出前调用其stop方法可以写出队列中剩余的日志
+    """
+
+    handler = logging.StreamHandler(sys.stderr if stream is None else stream)
+    handler.setFormatter(StructuredFormatter())
+    records = queue.Queue(-1)
+    queue_handler = QueueHandler(records)
+    queue_handler.addFilter(SamplingFilter(debug_sample_rate))
+
+    logger = logging.getLogger(LOGGER_NAME)
+    for old_handler in list(logger.handlers):
+        if isinstance(old_handler, QueueHandler):
+            logger.removeHandler(old_handler)
+    logger.addHandler(queue_handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+    listener = QueueListener(records, handler)
+    listener.start()
+    return listener
@@ -0,0 +1,119 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Histogram:
+    """
+    直方图
+    按标签值分别统计观测值落在各个区间内的次数、总和与总次数，可以输出为Prometheus文本格式，多线程同时记录时是安全的
+    """
+
+    # 默认的区间上界（秒）
+    default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, label, buckets=None):
+        """
+        构造函数
+        :param name: 指标名
+        :param documentation: 指标说明
+        :param label: 标签名
+        :param buckets: 区间上界（升序），为None时使用类属性default_buckets
+        """
+
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._buckets = tuple(self.default_buckets if buckets is None else buckets)
+        # 标签值 -> [各区间的次数（最后一个为+Inf）, 总和, 总次数]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        """
+        记录一个观测值
+        :param label_value: 标签值
+        :param value: 观测值
+        :return: 无
+        """
+
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            values = self._values.get(label_value)
+            if values is None:
+                values = self._values[label_value] = [[0] * (len(self._buckets) + 1), 0.0, 0]
+            values[0][index] += 1
+            values[1] += value
+            values[2] += 1
+
+    def render(self):
+        """
+        输出为Prometheus文本格式
+        :return: 字符串
+        """
+
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} histogram'.format(self.name)
+        ]
+        with self._lock:
+            values = sorted((label_value, list(counts), total, count)
+                            for label_value, (counts, total, count) in self._values.items())
+        for label_value, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self._buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{{{}="{}",le="{}"}} {}'.format(self.name, self.label, label_value,
+                                                                     bound, cumulative))
+            lines.append('{}_sum{{{}="{}"}} {}'.format(self.name, self.label, label_value, total))
+            lines.append('{}_count{{{}="{}"}} {}'.format(self.name, self.label, label_value, count))
+        return '\n'.join(lines) + '\n'
+
+
+# 推理各阶段的耗时
+STAGE_SECONDS = Histogram('rca_stage_duration_seconds', 'Time spent in each stage of root cause analysis.', 'stage')
+
+_local = threading.local()
+
+
+@contextmanager
+def timed(stage):
+    """
+    统计一个阶段的耗时（单调时钟），记入STAGE_SECONDS；如果当前线程正在通过collect_stages收集分阶段耗时，同时累加到其中
+    :param stage: 阶段名
+    :return: 上下文管理器
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(stage, elapsed)
+        stages = getattr(_local, 'stages', None)
+        if stages is not None:
+            stages[stage] = stages.get(stage, 0) + elapsed
+
+
+@contextmanager
+def collect_stages():
+    """
+    收集当前线程中各阶段的耗时（例如一次请求的分阶段耗时），同一阶段多次执行时累加
+    :return: 上下文管理器，得到dict：阶段名 -> 耗时（秒）
+    """
+
+    previous = getattr(_local, 'stages', None)
+    stages = _local.stages = {}
+    try:
+        yield stages
+    finally:
+        _local.stages = previous
+
+
+def render():
+    """
+    将所有指标输出为Prometheus文本格式
+    :return: 字符串
+    """
+    return STAGE_SECONDS.render()
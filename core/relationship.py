@@ -1,16 +1,22 @@
-import json
 import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
 
 import networkx as nx
 import numpy as np
 import pandas as pd
 from pgmpy.estimators import BayesianEstimator
+from pgmpy.factors.discrete import TabularCPD
 from pgmpy.inference import VariableElimination
+from pgmpy.inference.EliminationOrder import MinFill
 from pgmpy.models import BayesianModel
 from tqdm import tqdm
 
+from core.cache import LRUCache
 from core.clustering import Clustering
-from core.scanner import TemplateScanner
+from core.dag import TopologicalOrder
+from core.metrics import timed
+from core.scanner import TemplateScanner, source_files
 from core.topology import Topology
 from core.utils import echarts_from_nx
 from settings import Settings
@@ -21,30 +27,259 @@ class Relationship:
     构建根因推理图（贝叶斯网络）以及推理模型（变量消解）
     """
 
-    def __init__(self, tpl: TemplateScanner, top: Topology):
+    # 后验概率缓存的容量
+    posterior_cache_size = 4096
+    # 是否在启动时对整个网络计算一次变量消解顺序，并直接在条件概率表数组上按该顺序进行变量消解
+    # （不复制、剪枝模型，也不构造pgmpy的因子）；否则每次查询都通过pgmpy按MinFill启发式重新计算
+    precompute_elimination_order = True
+    # 根因与其附近的日志模板共同出现达到该次数时，才在根因推理图中加入对应的边
+    dag_edge_threshold = 3
+    # 根因推理图中边的加入顺序（先加入的边优先保留，后加入的边会形成环时被舍弃）：
+    # reached为共现次数达到阈值的先后顺序，weight为共现次数从大到小的顺序（次数相同时按达到阈值的先后）
+    dag_edge_order = 'reached'
+    # BDeu先验的等效样本量
+    equivalent_sample_size = 5
+
+    def __init__(self, tpl: TemplateScanner, top: Topology, store=None):
         """
         构造函数，该方法内将会自动调用类中的_get_dag，_train_bn等私有成员，完成根因推理图的构建和推理模型的初始化
         :param tpl: 日志模板扫描器类
         :param top: 拓扑结构类
+        :param store: 模型文件（core.store.ModelStore），增量学习后将事件文件和更新的模型保存到其中，为None时不保存
         """
 
         self._tpl = tpl
         self._top = top
+        self._store = store
+        self._training_records = self._get_training_records()
+        self._root_templates = frozenset(record['root'] for record in self._training_records)
         self._dag = self._get_dag()
-        self._model = self._train_bn()
-        self._model_infer = VariableElimination(self._model)
+        self._local = threading.local()
+        self._update_lock = threading.Lock()
+        self._state_counts = None
+        self._generation = 0
+        self._use_model(self._train_bn())
+
+    @classmethod
+    def from_arrays(cls, tpl: TemplateScanner, top: Topology, arrays, store=None):
+        """
+        从to_arrays导出的数组恢复根因推理图和推理模型，无需重新训练
+        :param tpl: 日志模板扫描器类
+        :param top: 拓扑结构类
+        :param arrays: 数组字典
+        :param store: 模型文件，含义同构造函数
+        :return: Relationship
+        """
+
+        relationship = cls.__new__(cls)
+        relationship._tpl = tpl
+        relationship._top = top
+        relationship._store = store
+
+        data = arrays['record_data'].tolist()
+        indptr = arrays['record_indptr'].tolist()
+        relationship._training_records = [{
+            'data': data[indptr[i]:indptr[i + 1]],
+            'root': root
+        } for i, root in enumerate(arrays['record_roots'].tolist())]
+        relationship._root_templates = frozenset(record['root'] for record in relationship._training_records)
+        relationship._pair_counts = {}
+        for record in relationship._training_records:
+            relationship._count_pairs(relationship._pair_counts, record)
+
+        dag = nx.DiGraph()
+        dag.add_nodes_from(str(x) for x in arrays['dag_nodes'].tolist())
+        dag.add_edges_from((str(u), str(v)) for u, v in arrays['dag_edges'].tolist())
+        relationship._dag = dag
+        relationship._dag_order = TopologicalOrder(dag)
+
+        model = BayesianModel(dag.edges)
+        model.add_nodes_from(dag.nodes)
+        variables = [str(x) for x in arrays['cpd_variables'].tolist()]
+        state_indptr = arrays['state_indptr'].tolist()
+        state_values = arrays['state_values'].tolist()
+        state_names = {variable: state_values[state_indptr[i]:state_indptr[i + 1]]
+                       for i, variable in enumerate(variables)}
+        evidence = [str(x) for x in arrays['cpd_evidence'].tolist()]
+        evidence_indptr = arrays['cpd_evidence_indptr'].tolist()
+        values = arrays['cpd_values']
+        values_indptr = arrays['cpd_values_indptr'].tolist()
+        for i, variable in enumerate(variables):
+            parents = evidence[evidence_indptr[i]:evidence_indptr[i + 1]]
+            cardinality = len(state_names[variable])
+            model.add_cpds(TabularCPD(
+                variable, cardinality,
+                np.array(values[values_indptr[i]:values_indptr[i + 1]]).reshape(cardinality, -1),
+                evidence=parents or None,
+                evidence_card=[len(state_names[parent]) for parent in parents] or None,
+                state_names={x: state_names[x] for x in [variable] + parents}))
 
+        elimination_order = None
+        if 'elimination_order' in arrays:
+            elimination_order = [str(x) for x in arrays['elimination_order'].tolist()]
+
+        relationship._local = threading.local()
+        relationship._update_lock = threading.Lock()
+        relationship._state_counts = None
+        relationship._generation = 0
+        relationship._use_model(model, elimination_order)
+        return relationship
+
+    def to_arrays(self):
+        """
+        将训练数据、根因推理图、条件概率表以及变量消解顺序导出为数组，用于保存到模型文件
+        :return: 数组字典
+        """
+
+        records = self._training_records
+        cpds = [self._model.get_cpds(node) for node in self._model.nodes()]
+        arrays = {
+            'record_data': np.array([x for record in records for x in record['data']], dtype=np.int64),
+            'record_indptr': np.cumsum([0] + [len(record['data']) for record in records], dtype=np.int64),
+            'record_roots': np.array([record['root'] for record in records], dtype=np.int64),
+            'dag_nodes': np.array([int(x) for x in self._dag.nodes], dtype=np.int64),
+            'dag_edges': np.array([(int(u), int(v)) for u, v in self._dag.edges], dtype=np.int64).reshape(-1, 2),
+            'cpd_variables': np.array([int(cpd.variable) for cpd in cpds], dtype=np.int64),
+            'state_values': np.array([x for cpd in cpds for x in cpd.state_names[cpd.variable]], dtype=np.float64),
+            'state_indptr': np.cumsum([0] + [len(cpd.state_names[cpd.variable]) for cpd in cpds], dtype=np.int64),
+            'cpd_evidence': np.array([int(x) for cpd in cpds for x in cpd.variables[1:]], dtype=np.int64),
+            'cpd_evidence_indptr': np.cumsum([0] + [len(cpd.variables) - 1 for cpd in cpds], dtype=np.int64),
+            'cpd_values': np.concatenate([cpd.values.ravel() for cpd in cpds]).astype(np.float64),
+            'cpd_values_indptr': np.cumsum([0] + [cpd.values.size for cpd in cpds], dtype=np.int64)
+        }
+        if self._elimination_order is not None:
+            arrays['elimination_order'] = np.array([int(x) for x in self._elimination_order], dtype=np.int64)
+        return arrays
+
+    @timed('posterior')
     def get_possibility_when(self, evidence, variable):
         """
-        计算后验概率 P(variable | evidence1, evidence2, ...)
+        计算后验概率 P(variable = 1 | evidence1 = 1, evidence2 = 1, ...)
+        相同的(变量, 条件)会直接从缓存中返回
         :param evidence: 条件
         :param variable: 变量
         :return: 后验概率值
         """
 
-        return self._model_infer.query(variables=[str(variable)], evidence={
-            str(x): 1 for x in evidence
-        })
+        variable = str(variable)
+        evidence = self._known_evidence(evidence)
+        key = (variable, evidence)
+        cache = self._posterior_cache
+        phi = cache.get(key)
+        if phi is None:
+            phi = self._query([variable], evidence)[variable]
+            cache.put(key, phi)
+        return phi
+
+    @timed('posterior')
+    def get_possibilities_when(self, queries):
+        """
+        批量计算后验概率，含义同get_possibility_when，条件相同的查询合并为一次查询
+        :param queries: 查询列表，元素为(变量, 条件)
+        :return: 与queries一一对应的后验概率值列表
+        """
+
+        keys = [(str(variable), self._known_evidence(evidence)) for variable, evidence in queries]
+        cache = self._posterior_cache
+        result = {}
+        pending = {}
+        for key in keys:
+            if key in result:
+                continue
+            phi = cache.get(key)
+            if phi is None:
+                pending.setdefault(key[1], set()).add(key[0])
+            else:
+                result[key] = phi
+
+        for evidence, variables in pending.items():
+            for variable, phi in self._query(sorted(variables), evidence).items():
+                result[(variable, evidence)] = phi
+                cache.put((variable, evidence), phi)
+
+        return [result[key] for key in keys]
+
+    def learn(self, path):
+        """
+        增量学习一个新的带根因标记的事件文件，无需重新训练：
+        累加根因与附近日志模板的共现次数，只在根因推理图中加入新达到阈值的边，
+        并只更新受影响的条件概率表（父节点变化或状态取值变化的节点重新估计，其余节点根据保存的计数更新对应的一列）。
+        更新在训练数据、共现次数和模型的副本上完成后整体替换，不影响正在进行的推理；
+        估计或保存失败时保持原来的状态，重试时该事件不会被重复计入
+        :param path: 带根因标记的csv文件路径，也可以是csv文件内容（bytes）或文件对象
+        :return: 是否学习到了新的事件，文件中没有根因标记时返回False
+        """
+
+        content = _read_content(path)
+        record = _cluster_training_file(self._tpl, self._top, content)
+        if record is None:
+            return False
+
+        with self._update_lock:
+            if self._state_counts is None:
+                self._state_counts = self._count_states(self._model, self._get_training_data())
+
+            records = self._training_records + [record]
+            pair_counts = dict(self._pair_counts)
+            dag = self._dag.copy()
+            dag_order = self._dag_order.copy(dag)
+            added = self._add_edges(dag_order, self._count_pairs(pair_counts, record))
+            model = self._model.copy()
+            model.add_edges_from(added)
+
+            row = {node: 0.0 for node in model.nodes()}
+            for template in record['data']:
+                if str(template) in row:
+                    row[str(template)] = 1.0
+
+            # 状态取值发生变化的节点及其子节点、父节点发生变化的节点、新加入的节点（在线学习到的日志模板）需要重新估计
+            refit = {v for u, v in added}
+            for node in model.nodes():
+                cpd = model.get_cpds(node)
+                if cpd is None or row[node] not in cpd.state_names[node]:
+                    refit.add(node)
+                    refit.update(model.get_children(node))
+
+            state_counts = dict(self._state_counts)
+            for node in model.nodes():
+                if node not in refit:
+                    state_counts[node] = self._update_cpd(model.get_cpds(node), state_counts[node], row)
+            if refit:
+                estimator = BayesianEstimator(model, self._get_training_data(records)[list(model.nodes())])
+                for node in refit:
+                    model.add_cpds(estimator.estimate_cpd(node, prior_type='BDeu',
+                                                          equivalent_sample_size=self.equivalent_sample_size))
+                    state_counts[node] = estimator.state_counts(node).values.astype(float)
+
+            previous = self._swap(records, pair_counts, state_counts, dag, dag_order,
+                                  self._root_templates | {record['root']}, model)
+            if self._store is not None:
+                incident = None
+                try:
+                    incident = self._store.add_incident(content)
+                    self._store.save(self._tpl, self._top, self)
+                except Exception:
+                    # 保存失败时恢复原来的状态
+                    if incident is not None:
+                        self._store.remove_incident(incident)
+                    self._swap(*previous)
+                    raise
+
+        return True
+
+    def get_root_templates(self):
+        """
+        获取训练数据中作为根因出现过的日志模板分类ID，只有这些模板的事件才会被当作根因候选
+        :return: 日志模板分类ID的集合
+        """
+        return self._root_templates
+
+    def get_posterior_cache_info(self):
+        """
+        获取后验概率缓存的统计信息
+        :return: dict，包含hits，misses，size，capacity
+        """
+        return self._posterior_cache.info()
 
     def draw(self, path):
         """
@@ -59,33 +294,141 @@ class Relationship:
             nx_desc.add_edge(self._tpl.get_message_by_template(int(u)), self._tpl.get_message_by_template(int(v)))
         echarts_from_nx(nx_desc, path, '推理图')
 
-    def _get_training_data(self):
-        cache_path = '{}/.rel_td'.format(Settings.training_data_path)
-
-        if not os.path.exists(cache_path):
-            raw_training_data = []
-
-            for i in tqdm(range(Settings.n_training_data)):
-                self._tpl.init('{}/{}.csv'.format(Settings.training_data_path, i), True)
-                cls = Clustering(self._tpl, self._top)
-                root_cause = cls.get_root_cause()
-                mapping = cls.get_node_to_log_mapping()
-                if root_cause is None:
-                    continue
-                data = []
-                for u in cls.cluster_by_topology(root_cause['node']).nodes:
-                    for log in mapping[u]:
-                        data.append(log['template'])
-
-                raw_training_data.append({
-                    'data': data,
-                    'root': root_cause['template']
-                })
-
-            json.dump(raw_training_data, open(cache_path, 'w'))
-        else:
-            raw_training_data = json.load(open(cache_path, 'r'))
+    def _use_model(self, model, elimination_order=None):
+        # 替换推理使用的模型：后验概率缓存、消解顺序随之更新，各线程的推理实例在下次查询时重建
+        if not self.precompute_elimination_order:
+            elimination_order = None
+        elif elimination_order is None:
+            elimination_order = MinFill(model).get_elimination_order(show_progress=False)
+        self._model = model
+        self._elimination_order = elimination_order
+        self._compiled = None if elimination_order is None else self._compile(model, elimination_order)
+        self._posterior_cache = LRUCache(self.posterior_cache_size)
+        self._generation += 1
+        # 最后替换可作为条件的变量：新加入的变量只会在新的模型上查询
+        self._variables = frozenset(model.nodes())
+
+    def _swap(self, records, pair_counts, state_counts, dag, dag_order, root_templates, model,
+              elimination_order=None):
+        # 整体替换增量学习涉及的状态，返回原来的状态
+        previous = (self._training_records, self._pair_counts, self._state_counts, self._dag, self._dag_order,
+                    self._root_templates, self._model, self._elimination_order)
+        self._training_records = records
+        self._pair_counts = pair_counts
+        self._state_counts = state_counts
+        self._dag = dag
+        self._dag_order = dag_order
+        self._root_templates = root_templates
+        self._use_model(model, elimination_order)
+        return previous
+
+    def _known_evidence(self, evidence):
+        # 在线学习到的日志模板在通过增量学习加入根因推理图之前不在推理模型中，不能作为条件
+        variables = self._variables
+        return frozenset(x for x in (str(x) for x in evidence) if x in variables)
+
+    def _update_cpd(self, cpd, counts, row):
+        # 新的一条训练数据只影响条件概率表中与其父节点取值对应的一列，按BDeu先验重新计算这一列
+        states = cpd.state_names
+        column = 0
+        for parent in cpd.variables[1:]:
+            column = column * len(states[parent]) + states[parent].index(row[parent])
+        counts = counts.copy()
+        counts[states[cpd.variable].index(row[cpd.variable]), column] += 1
+
+        pseudo_counts = counts[:, column] + float(self.equivalent_sample_size) / counts.size
+        values = cpd.get_values().copy()
+        values[:, column] = pseudo_counts / pseudo_counts.sum()
+        cpd.values = values.reshape(cpd.cardinality)
+        return counts
+
+    def _count_states(self, model, data):
+        estimator = BayesianEstimator(model, data[list(model.nodes())])
+        return {node: estimator.state_counts(node).values.astype(float) for node in model.nodes()}
+
+    @timed('variable_elimination')
+    def _query(self, variables, evidence):
+        # 返回各变量取值为1的后验概率
+        compiled = self._compiled
+        if compiled is not None:
+            return {variable: self._eliminate(compiled, variable, evidence) for variable in variables}
+        try:
+            phis = self._get_model_infer().query(variables=variables, evidence={x: 1 for x in evidence},
+                                                 elimination_order='MinFill', joint=False, show_progress=False)
+        except Exception:
+            # 查询失败时推理实例持有的模型停留在剪枝后的状态，丢弃该实例
+            self._local.model_infer = None
+            raise
+        return {variable: float(phi.values[phi.state_names[variable].index(1)]) for variable, phi in phis.items()}
+
+    def _compile(self, model, elimination_order):
+        # 整理各节点的条件概率表数组及其变量、取值为1的状态下标、祖先节点，供_eliminate使用
+        factors = {}
+        observed = {}
+        for node in model.nodes():
+            cpd = model.get_cpds(node)
+            factors[node] = (cpd.values, cpd.variables)
+            states = cpd.state_names[node]
+            observed[node] = states.index(1) if 1 in states else None
+        ancestors = {node: nx.ancestors(model, node) for node in model.nodes()}
+        return factors, observed, ancestors, elimination_order
+
+    def _eliminate(self, compiled, variable, evidence):
+        # 只保留查询变量和条件的祖先节点（其余节点求和后为1），条件变量取值固定为1，
+        # 再按预先计算的顺序逐个消去其余变量：相乘含该变量的因子并对其求和
+        factors, observed, ancestors, elimination_order = compiled
+        relevant = {variable} | evidence
+        for node in list(relevant):
+            relevant |= ancestors[node]
+
+        pending = []
+        for node in relevant:
+            values, scope = factors[node]
+            index = []
+            kept = []
+            for x in scope:
+                if x in evidence:
+                    if observed[x] is None:
+                        raise ValueError('条件变量{}在训练数据中没有出现过取值1'.format(x))
+                    index.append(observed[x])
+                else:
+                    index.append(slice(None))
+                    kept.append(x)
+            # 全部变量都是条件的因子是常数，归一化时约去
+            if kept:
+                pending.append((values[tuple(index)], kept))
 
+        for x in elimination_order:
+            if x not in relevant or x in evidence or x == variable:
+                continue
+            involved = [factor for factor in pending if x in factor[1]]
+            pending = [factor for factor in pending if x not in factor[1]]
+            scope = list({y: None for values, kept in involved for y in kept if y != x})
+            pending.append((_product(involved, scope), scope))
+
+        values = _product(pending, [variable])
+        return float(values[observed[variable]] / values.sum()) if observed[variable] is not None else 0.0
+
+    def _get_model_infer(self):
+        # VariableElimination在查询过程中会临时替换自身持有的模型，因此每个线程各自持有一个推理实例
+        model_infer = getattr(self._local, 'model_infer', None)
+        if model_infer is None or self._local.generation != self._generation:
+            self._local.generation = self._generation
+            model_infer = VariableElimination(self._model)
+            self._local.model_infer = model_infer
+        return model_infer
+
+    def _get_training_records(self):
+        # 每个训练文件只解析、聚类一次，同时供根因推理图和训练数据使用，各文件在进程池中并行处理
+        paths = ['{}/{}.csv'.format(Settings.training_data_path, i) for i in range(Settings.n_training_data)]
+        paths += learned_files()
+        with ProcessPoolExecutor(Settings.n_workers, initializer=_init_training_worker,
+                                 initargs=(self._tpl, self._top)) as executor:
+            records = list(tqdm(executor.map(_preprocess_training_file, paths, chunksize=4), total=len(paths)))
+        return [record for record in records if record is not None]
+
+    def _get_training_data(self, records=None):
+        raw_training_data = self._training_records if records is None else records
         size = len(raw_training_data)
         training_data = np.zeros(shape=(size, len(self._tpl.get_templates())))
         for i in range(size):
@@ -97,71 +440,109 @@ class Relationship:
         return training_data
 
     def _get_dag(self):
+        # 先汇总所有训练数据的共现次数，每个(根因, 模板)最多尝试加入一次
+        self._pair_counts = {}
+        edges = []
+        for record in self._training_records:
+            edges.extend(self._count_pairs(self._pair_counts, record))
+        if self.dag_edge_order == 'weight':
+            edges.sort(key=lambda edge: self._pair_counts[edge], reverse=True)
+
         g = nx.DiGraph()
-        dag_path = '{}/.dag'.format(Settings.training_data_path)
-        if os.path.exists(dag_path):
-            g_file = json.load(open(dag_path, 'r'))
-            g.add_nodes_from(g_file['nodes'])
-            for u, v in g_file['edges']:
-                g.add_edge(u, v)
+        g.add_nodes_from(str(x[1]) for x in self._tpl.get_templates())
+        self._dag_order = TopologicalOrder(g)
+        self._add_edges(self._dag_order, edges)
 
-            return g
+        return g
 
-        g.add_nodes_from(str(x[1]) for x in self._tpl.get_templates())
+    def _count_pairs(self, pair_counts, record):
+        # 累加一条训练数据中根因与附近日志模板的共现次数，返回共现次数恰好达到阈值的(根因, 模板)。
+        # 图只增不减，已舍弃的边之后再次尝试同样会形成环，因此每一对只需在达到阈值时尝试一次
         edges = []
-        times = {}
-        for i in tqdm(range(Settings.n_training_data)):
-            self._tpl.init('{}/{}.csv'.format(Settings.training_data_path, i), True)
-            cls = Clustering(self._tpl, self._top)
-            root_cause = cls.get_root_cause()
-            mapping = cls.get_node_to_log_mapping()
-            if root_cause is None:
+        s = str(record['root'])
+        for template in record['data']:
+            t = str(template)
+            if s == t:
                 continue
-            top = cls.cluster_by_topology(root_cause['node'])
-            '''
-            for u, v in top.edges:
-                for logu in mapping[u]:
-                    for logv in mapping[v]:
-                        s = str(logu['template'])
-                        t = str(logv['template'])
-                        if s == t:
-                            continue
-                        if (s, t) not in times:
-                            times[s, t] = 0
-                        times[s, t] += 1
-                        if times[s, t] >= 9:
-                            edges.append((s, t, times[s, t]))
-            '''
-            s = str(root_cause['template'])
-            for node in top.nodes:
-                for log in mapping[node]:
-                    t = str(log['template'])
-                    if s == t:
-                        continue
-                    if (s, t) not in times:
-                        times[s, t] = 0
-                    times[s, t] += 1
-                    if times[s, t] >= 3:
-                        edges.append((s, t, times[s, t]))
-
-        sorted(edges, key=lambda x: x[2], reverse=True)
-
-        for u, v, w in edges:
-            try:
-                if not nx.has_path(g, v, u):
-                    g.add_edge(u, v)
-            except nx.NodeNotFound:
-                g.add_edge(u, v)
-
-        json.dump({
-            'edges': list(g.edges),
-            'nodes': list(g.nodes)
-        }, open(dag_path, 'w'))
+            count = pair_counts.get((s, t), 0) + 1
+            pair_counts[s, t] = count
+            if count == self.dag_edge_threshold:
+                edges.append((s, t))
+        return edges
 
-        return g
+    def _add_edges(self, dag_order, edges):
+        # 依次加入不会形成环的边，返回实际加入的边
+        return [(u, v) for u, v in edges if dag_order.add_edge(u, v)]
 
     def _train_bn(self):
         model = BayesianModel(self._dag.edges)
         model.add_nodes_from(self._dag.nodes)
-        model.fit(self._get_training_data(), BayesianEstimator, prior_type='BDeu')
+        model.fit(self._get_training_data(), BayesianEstimator, prior_type='BDeu',
+                  equivalent_sample_size=self.equivalent_sample_size)
         return model
+
+
+def learned_files():
+    """
+    获取通过增量学习保存的事件文件，重新训练时排在训练数据之后
+    :return: 按文件名（保存的先后）排序的csv文件路径列表，目录不存在时为空列表
+    """
+
+    if not os.path.isdir(Settings.learned_data_path):
+        return []
+    return source_files(Settings.learned_data_path)
+
+
+def _product(factors, scope):
+    # 相乘若干因子（(数组, 变量列表)）并对不在scope中的变量求和，返回按scope排列轴的数组
+    axes = {}
+    operands = []
+    for values, variables in factors:
+        operands.append(values)
+        operands.append([axes.setdefault(x, len(axes)) for x in variables])
+    operands.append([axes[x] for x in scope])
+    return np.einsum(*operands)
+
+
+def _read_content(path):
+    # 读取csv文件的内容（bytes），增量学习的事件文件需要原样保存
+    if isinstance(path, bytes):
+        return path
+    if isinstance(path, str):
+        with open(path, 'rb') as f:
+            return f.read()
+    content = path.read()
+    return content.encode('utf-8') if isinstance(content, str) else content
+
+
+# 训练数据预处理进程中使用的模板扫描器和拓扑图，由进程池的initializer设置
+_worker_tpl = None
+_worker_top = None
+
+
+def _init_training_worker(tpl, top):
+    global _worker_tpl, _worker_top
+    _worker_tpl = tpl
+    _worker_top = top
+
+
+def _preprocess_training_file(path):
+    return _cluster_training_file(_worker_tpl, _worker_top, path)
+
+
+def _cluster_training_file(tpl, top, path):
+    # 解析并聚类一个带根因标记的训练文件，得到根因附近出现的日志模板以及根因的日志模板
+    logs = tpl.parse(path, True)
+    cls = Clustering(tpl, top, logs)
+    root_cause = cls.get_root_cause()
+    if root_cause is None:
+        return None
+    mapping = cls.get_node_to_log_mapping()
+    data = []
+    for u in cls.cluster_by_topology(root_cause.node).nodes:
+        for log in mapping[u]:
+            data.append(log.template)
+    return {
+        'data': data,
+        'root': root_cause.template
+    }
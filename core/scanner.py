@@ -1,11 +1,21 @@
-import json
+import io
+import logging
+import math
 import os
 import sys
+import threading
 
 import numpy as np
 import pandas as pd
+from scipy import sparse
 from tqdm import tqdm
 
+from core.cache import LRUCache
+from core.log import fields
+from core.metrics import timed
+
+logger = logging.getLogger(__name__)
+
 sys.setrecursionlimit(100000)
 
 
@@ -82,6 +92,223 @@ def calc_similarity(a: str, b: str):
     return vec_a.dot(vec_b.T) / np.linalg.norm(vec_a) / np.linalg.norm(vec_b)
 
 
+class TemplateIndex:
+    """
+    日志模板索引
+    将每个模板的字符集合编码为位图（Python整数），并记录集合大小，
+    使得余弦相似度 |A∩B| / sqrt(|A|) / sqrt(|B|) 可以通过一次按位与和计数完成，
+    同时根据集合大小剪枝，并对与模板完全相同的文本提供哈希直达
+    """
+
+    def __init__(self, templates, threshold):
+        """
+        构造函数，预先计算所有模板的字符位图
+        :param templates: 日志模板列表，元素为(模板文字信息, 模板分类ID)
+        :param threshold: 相似度阈值
+        """
+
+        self._threshold = threshold
+        # 由集合大小得到的剪枝比例：余弦相似度不超过sqrt(min(|A|, |B|) / max(|A|, |B|))
+        self._min_ratio = threshold * threshold * (1 - 1e-9)
+        self._char_bits = {}
+        self._entries = []
+        for message, idx in templates:
+            chars = set(message)
+            for ch in chars:
+                if ch not in self._char_bits:
+                    self._char_bits[ch] = 1 << len(self._char_bits)
+            self._entries.append((self._to_bitmap(chars), len(chars), math.sqrt(len(chars)), idx))
+
+        # 与模板完全相同的文本，其匹配结果同样遵循“第一个超过阈值的模板”规则
+        self._exact = {}
+        for message, idx in templates:
+            if message not in self._exact:
+                self._exact[message] = self._scan(message)
+
+    def match(self, message):
+        """
+        查找第一个与文字信息相似度超过阈值的模板
+        :param message: 事件内容主体文字信息
+        :return: 对应的日志模板分类id，如果不存在则返回None
+        """
+
+        if message in self._exact:
+            return self._exact[message]
+        return self._scan(message)
+
+    def add(self, message, idx):
+        """
+        追加一个模板（排在已有模板之后），已有模板的位图不受影响：新出现的字符分配新的位，已有模板都不含这些字符
+        :param message: 模板文字信息
+        :param idx: 模板分类ID
+        :return: 无
+        """
+
+        chars = set(message)
+        for ch in chars:
+            if ch not in self._char_bits:
+                self._char_bits[ch] = 1 << len(self._char_bits)
+        self._entries.append((self._to_bitmap(chars), len(chars), math.sqrt(len(chars)), idx))
+        if message not in self._exact:
+            self._exact[message] = self._scan(message)
+
+    def _to_bitmap(self, chars):
+        bitmap = 0
+        for ch in chars:
+            bit = self._char_bits.get(ch)
+            if bit is not None:
+                bitmap |= bit
+        return bitmap
+
+    def _scan(self, message):
+        chars = set(message)
+        size = len(chars)
+        if size == 0:
+            return None
+        bitmap = self._to_bitmap(chars)
+        sqrt_size = math.sqrt(size)
+        for target_bitmap, target_size, sqrt_target_size, idx in self._entries:
+            if size < target_size:
+                if size < target_size * self._min_ratio:
+                    continue
+            elif target_size < size * self._min_ratio:
+                continue
+            common = bin(bitmap & target_bitmap).count('1')
+            if common / sqrt_target_size / sqrt_size > self._threshold:
+                return idx
+        return None
+
+
+# 未能匹配任何日志模板时，在模板分类ID数组中使用的占位值
+NO_TEMPLATE = -1
+# 缓存未命中的标记，与合法的返回值None区分
+_CACHE_MISS = object()
+
+
+class LogEvent:
+    """
+    一条结构化日志（事件）
+    使用__slots__，对象不带__dict__；文字信息引用LogBatch中不重复的文字信息列表，相同的文字信息只保存一份。
+    按值比较，仅在需要时（如接口返回结果）才通过to_dict构造成dict
+    """
+
+    __slots__ = ('node', 'message', 'template', 'is_root')
+
+    def __init__(self, node, message, template, is_root=None):
+        """
+        构造函数
+        :param node: 节点
+        :param message: 事件内容主体文字信息
+        :param template: 日志模板分类ID，未匹配到模板时为None
+        :param is_root: 是否为根因，没有根因标记时为None
+        """
+
+        self.node = node
+        self.message = message
+        self.template = template
+        self.is_root = is_root
+
+    def __eq__(self, other):
+        if not isinstance(other, LogEvent):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return 'LogEvent(node={}, message={!r}, template={}, is_root={})'.format(self.node, self.message,
+                                                                              self.template, self.is_root)
+
+    def to_dict(self):
+        """
+        将事件构造成dict
+        :return: 日志信息，包含node，message，template，以及（如果存在根因标记）is_root
+        """
+
+        log = {
+            'node': self.node,
+            'message': self.message,
+            'template': self.template
+        }
+        if self.is_root is not None:
+            log['is_root'] = self.is_root
+        return log
+
+    def _key(self):
+        return self.node, self.message, self.template, self.is_root
+
+
+class LogBatch:
+    """
+    结构化日志的列式存储
+    每条日志的节点、模板分类ID、根因标记分别存放在等长的数组中，
+    事件内容主体文字信息只保存一份不重复的列表，日志通过下标引用，
+    仅在需要时才构造成LogEvent
+    """
+
+    def __init__(self, nodes, templates, message_ids, messages, is_root=None, times=None):
+        """
+        构造函数
+        :param nodes: 节点数组
+        :param templates: 日志模板分类ID数组，未匹配到模板的位置为NO_TEMPLATE
+        :param message_ids: 文字信息下标数组
+        :param messages: 不重复的文字信息列表
+        :param is_root: 根因标记数组，没有根因标记时为None
+        :param times: 告警时间数组（numpy.datetime64），未读取时间时为None
+        """
+
+        self.nodes = nodes
+        self.templates = templates
+        self.message_ids = message_ids
+        self.messages = messages
+        self.is_root = is_root
+        self.times = times
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get_log(self, i):
+        """
+        将第i条日志构造成LogEvent
+        :param i: 日志下标
+        :return: LogEvent
+        """
+
+        template = int(self.templates[i])
+        return LogEvent(int(self.nodes[i]), self.messages[self.message_ids[i]],
+                        None if template == NO_TEMPLATE else template,
+                        None if self.is_root is None else bool(self.is_root[i]))
+
+    def take(self, indices):
+        """
+        按下标取出部分日志，组成新的LogBatch（共享不重复的文字信息列表）
+        :param indices: 日志下标数组
+        :return: LogBatch
+        """
+
+        is_root = None if self.is_root is None else self.is_root[indices]
+        times = None if self.times is None else self.times[indices]
+        return LogBatch(self.nodes[indices], self.templates[indices], self.message_ids[indices], self.messages,
+                        is_root, times)
+
+    def to_dicts(self):
+        """
+        将所有日志构造成dict
+        :return: 日志信息列表
+        """
+        return [self.get_log(i).to_dict() for i in range(len(self))]
+
+
+def source_files(tpl_source):
+    """
+    获取日志模板训练目录下的所有数据文件
+    :param tpl_source: 日志模板训练目录
+    :return: 按文件名排序的csv文件路径列表
+    """
+    return sorted(os.path.join(tpl_source, name) for name in os.listdir(tpl_source) if name.endswith('.csv'))
+
+
 class TemplateScanner:
     """
     模板扫描器
@@ -89,49 +316,76 @@ class TemplateScanner:
 
     # 相似度阈值
     log_parse_similarity_threshold = 0.80
-
-    def __init__(self, tpl_source):
+    # 批量计算相似度时，每个分块内相似度矩阵元素个数的上限，用于限制内存占用
+    similarity_block_elements = 1 << 22
+    # 文字信息 -> 日志模板分类ID 缓存的容量
+    template_cache_size = 65536
+    # 是否在线学习未能匹配任何日志模板的文字信息（作为新的模板），为False时这些日志被忽略
+    learn_unmatched = True
+
+    def __init__(self, tpl_source, journal=None):
         """
-        构造函数，加载日志模板配置，如果不存在缓存，则根据日志模板训练目录训练并生成日志模板配置文件，如果存在缓存则直接从缓存中加载
+        构造函数，根据日志模板训练目录训练得到日志模板（训练结果由core.store中的模型文件保存，见from_arrays）
         :param tpl_source: 日志模板训练目录
+        :param journal: 在线学习的日志模板记录（core.store.TemplateJournal），多个进程通过它分配一致的模板分类ID，
+                        为None时只在本进程内学习，不保存
         """
 
         self._tpl_source = tpl_source
-        self._templates = []
-        self._log_parse_similarity_threshold = self.log_parse_similarity_threshold
-        self._source_log_entries = []
-        self._log_entries = []
-        self._template_freq = {}
-        self._freq_total = 0
+        self._journal = journal
+        self._init_state()
+        self._scan_tpl_source()
+        self._get_templates()
+        self._init_freq()
+
+    @classmethod
+    def from_arrays(cls, arrays, journal=None):
+        """
+        从to_arrays导出的数组恢复日志模板扫描器，无需重新训练
+        :param arrays: 数组字典
+        :param journal: 在线学习的日志模板记录，含义同构造函数
+        :return: TemplateScanner
+        """
 
-        path_templates_cache = '{}/.tpls'.format(tpl_source)
-        if not os.path.exists(path_templates_cache):
-            print('找不到缓存')
-            self._scan_tpl_source()
-            self._get_templates()
-            json.dump({
-                'info': self._templates,
-                'freq': self._template_freq
-            }, open(path_templates_cache, 'w'))
-        else:
-            print('从缓存加载日志模板')
-            cached = json.load(open(path_templates_cache, 'r'))
-            self._templates = [(name, index) for name, index in cached['info']]
-            self._template_freq = {int(index): freq for index, freq in cached['freq'].items()}
+        scanner = cls.__new__(cls)
+        scanner._tpl_source = None
+        scanner._journal = journal
+        scanner._init_state()
+        text = arrays['text'].tobytes()
+        offsets = arrays['offsets'].tolist()
+        for i, index in enumerate(arrays['ids'].tolist()):
+            scanner._templates.append((text[offsets[i]:offsets[i + 1]].decode('utf-8'), index))
+        scanner._template_freq = dict(zip(arrays['ids'].tolist(), arrays['freq'].tolist()))
+        scanner._build_index()
+        scanner._init_freq()
+        return scanner
+
+    def to_arrays(self):
+        """
+        将日志模板及其频率导出为数组，用于保存到模型文件
+        :return: 数组字典
+        """
 
-        self._templates_dict = {index: name for name, index in self._templates}
-        for freq in self._template_freq.values():
-            self._freq_total += freq
+        with self._learn_lock:
+            encoded = [name.encode('utf-8') for name, index in self._templates]
+            ids = [index for name, index in self._templates]
+            freq = [self._template_freq[index] for index in ids]
+        return {
+            'text': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+            'offsets': np.cumsum([0] + [len(x) for x in encoded], dtype=np.int64),
+            'ids': np.array(ids, dtype=np.int64),
+            'freq': np.array(freq, dtype=np.int64)
+        }
 
     def get_freq(self, tpl_id):
         """
         获取某个日志模板分类ID出现的总频率
         往往用于按照频率过滤噪声时
         :param tpl_id: 日志模板分类ID
-        :return: 频率
+        :return: 频率，未知的分类ID（如NO_TEMPLATE）为0
         """
 
-        return self._template_freq[tpl_id] / self._freq_total
+        return self._template_freq.get(tpl_id, 0) / self._freq_total
 
     def get_message_by_template(self, tpl_id):
         """
@@ -147,36 +401,113 @@ class TemplateScanner:
         :param message: 事件内容主体文字信息
         :return: 对应的日志模板分类id，如果不存在则返回None
         """
-        for target_message, idx in self._templates:
-            if calc_similarity(target_message, message) > self.log_parse_similarity_threshold:
-                return idx
 
-    def init(self, log_file_path, root_cause_label=False):
+        tpl_id = self._template_cache.get(message, _CACHE_MISS)
+        if tpl_id is _CACHE_MISS:
+            tpl_id = self._index.match(message)
+            self._template_cache.put(message, tpl_id)
+        return tpl_id
+
+    def get_template_cache_info(self):
         """
-        初始化某一个训练/测试数据文件，该过程将该文件（csv）中的所有数据结构化，存储到self._log_entries中，通过get_logs获取
-        :param log_file_path: 日志文件路径
-        :param root_cause_label: 是否添加根因标记，对于训练数据需要添加，测试数据不需要（因为测试数据本来就要人为添加这个）
+        获取文字信息 -> 日志模板分类ID 缓存的统计信息
+        :return: dict，包含hits，misses，size，capacity
+        """
+        return self._template_cache.info()
+
+    def learn_templates(self, messages, counts=None):
+        """
+        在线学习未能匹配任何日志模板的文字信息，无需重新训练：
+        仍然无法匹配的文字信息作为新的模板追加到模板索引的末尾（已有模板的匹配结果不变），
+        之后与其相似的文字信息都会匹配到该模板，本次学习中匹配到新模板的文字信息的出现次数计入该模板的频率。
+        有模板记录时，先读入其他进程学习到的模板再分配分类ID，新的模板追加到记录中（不重写模型文件）
+        :param messages: 文字信息列表
+        :param counts: 各文字信息的出现次数，为None时均为1
+        :return: 与messages一一对应的日志模板分类ID列表
+        """
+
+        if counts is None:
+            counts = [1] * len(messages)
+        with self._learn_lock:
+            if self._journal is None:
+                return self._learn(messages, counts)[0]
+
+            result = []
+
+            def learn(entries):
+                is_consistent = self._merge(entries)
+                ids, learned = self._learn(messages, counts)
+                result.extend(ids)
+                return learned, is_consistent
+
+            self._journal.update(learn)
+            return result
+
+    def sync_templates(self):
+        """
+        读入其他进程在线学习到的日志模板（加载模型后调用），没有模板记录时不做任何事
         :return: 无
         """
-        self._log_entries = []
-        df = pd.read_csv(log_file_path)
-        for index, event in df.iterrows():
-            msg_raw = event['triggername'].split(' ', 1)
-            tmp = {
-                'node': int(msg_raw[0].split('_')[1]),
-                'message': msg_raw[1],
-                'template': self.get_template_id(msg_raw[1])
-            }
-            if root_cause_label:
-                tmp['is_root'] = int(event['is_root']) == 1
-            self._log_entries.append(tmp)
+        self.learn_templates([])
 
-    def get_logs(self):
+    @timed('parse')
+    def parse(self, log_file_path, root_cause_label=False, with_time=False):
         """
-        获取所有结构化的日志信息
-        :return: 结构化的日志信息
+        将某一个训练/测试数据文件（csv）整体结构化为列式存储。
+        解析结果只属于本次调用，除在线学习新的模板（见learn_templates）外扫描器本身的状态不会被修改，
+        因此可以在多个线程中同时解析不同的文件
+        :param log_file_path: 日志文件路径，也可以是csv文件内容（bytes）或文件对象（如上传的文件流），无需先写入磁盘
+        :param root_cause_label: 是否添加根因标记，对于训练数据需要添加，测试数据不需要（因为测试数据本来就要人为添加这个）
+        :param with_time: 是否读取告警时间（time列），按时间切分事件时需要
+        :return: LogBatch
         """
-        return self._log_entries
+
+        if isinstance(log_file_path, bytes):
+            log_file_path = io.BytesIO(log_file_path)
+        columns = ['triggername', 'is_root'] if root_cause_label else ['triggername']
+        if with_time:
+            columns.append('time')
+        df = pd.read_csv(log_file_path, usecols=columns, dtype={'triggername': 'category'})
+
+        # 告警文本大量重复，只对不重复的文本做拆分和模板匹配，再按分类编码展开到每一行
+        events = df['triggername'].cat
+        msg_raw = pd.Series(events.categories.astype(str), dtype=object).str.split(' ', n=1)
+        category_nodes = pd.to_numeric(msg_raw.str[0].str.split('_', n=2).str[1], errors='coerce')
+        category_messages = msg_raw.str[1]
+        # 告警文本为空、不含事件内容主体或无法解析出节点的行无法结构化，丢弃（分类编码-1不能作为下标使用）
+        is_valid = (category_nodes.notna() & category_messages.map(lambda x: isinstance(x, str) and x != '')).to_numpy()
+        codes = events.codes.to_numpy()
+        rows = codes >= 0
+        rows[rows] = is_valid[codes[rows]]
+        if not rows.all():
+            logger.warning('丢弃无法解析的告警', extra=fields(count=int((~rows).sum())))
+            df = df[rows]
+            codes = codes[rows]
+        event_nodes = category_nodes.fillna(-1).astype(np.int64).to_numpy()
+        event_message_ids, messages = pd.factorize(category_messages.where(is_valid))
+        messages = messages.tolist()
+
+        template_of_message = np.empty(len(messages), dtype=np.int64)
+        with timed('match_templates'):
+            for i, message in enumerate(messages):
+                template = self.get_template_id(message)
+                template_of_message[i] = NO_TEMPLATE if template is None else template
+
+        message_ids = event_message_ids[codes]
+        unmatched = np.flatnonzero(template_of_message == NO_TEMPLATE)
+        if len(unmatched) > 0 and self.learn_unmatched:
+            counts = np.bincount(message_ids, minlength=len(messages))
+            template_of_message[unmatched] = self.learn_templates([messages[i] for i in unmatched.tolist()],
+                                                                  counts[unmatched].tolist())
+        is_root = None
+        if root_cause_label:
+            is_root = df['is_root'].astype(int).to_numpy() == 1
+
+        times = None
+        if with_time:
+            times = pd.to_datetime(df['time'], format='%Y-%m-%d %H:%M:%S').to_numpy()
+
+        return LogBatch(event_nodes[codes], template_of_message[message_ids], message_ids, messages, is_root, times)
 
     def get_templates(self):
         """
@@ -185,48 +516,147 @@ class TemplateScanner:
         """
         return self._templates
 
+    def __getstate__(self):
+        # 锁和模板记录无法序列化；传递到训练进程的副本不在线学习模板（各进程分配的分类ID会相互冲突），
+        # 未能匹配的日志在聚类时被过滤
+        state = self.__dict__.copy()
+        del state['_learn_lock']
+        state['_journal'] = None
+        state['learn_unmatched'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._learn_lock = threading.Lock()
+
+    def _learn(self, messages, counts):
+        # 学习仍然无法匹配的文字信息，返回(分类ID列表, 新的模板列表)
+        result = []
+        learned = {}
+        for message, count in zip(messages, counts):
+            # 其他线程可能已经学习到了匹配的模板
+            tpl_id = self._index.match(message)
+            if tpl_id is None:
+                tpl_id = self._add_template(message, 0)
+                learned[tpl_id] = {'id': tpl_id, 'message': message, 'count': 0}
+                logger.info('学习到新的日志模板', extra=fields(template=tpl_id, message=message))
+            if tpl_id in learned:
+                learned[tpl_id]['count'] += count
+                self._template_freq[tpl_id] += count
+                self._freq_total += count
+            result.append(tpl_id)
+        return result, list(learned.values())
+
+    def _merge(self, entries):
+        # 依次加入记录中其他进程学习到的模板，已有的模板跳过；记录与已有模板不一致（来自其他模型）时返回False
+        for entry in entries:
+            tpl_id = entry['id']
+            if tpl_id < len(self._templates):
+                if self._templates[tpl_id][0] != entry['message']:
+                    return False
+            elif tpl_id == len(self._templates):
+                self._add_template(entry['message'], entry['count'])
+            else:
+                return False
+        return True
+
+    def _add_template(self, message, count):
+        tpl_id = len(self._templates)
+        self._templates.append((message, tpl_id))
+        self._templates_dict[tpl_id] = message
+        self._template_freq[tpl_id] = count
+        self._freq_total += count
+        self._index.add(message, tpl_id)
+        # 缓存中未匹配的结果可能已经过期
+        self._template_cache.clear()
+        return tpl_id
+
+    def _init_state(self):
+        self._templates = []
+        self._log_parse_similarity_threshold = self.log_parse_similarity_threshold
+        self._source_log_entries = []
+        self._template_freq = {}
+        self._freq_total = 0
+        self._template_cache = LRUCache(self.template_cache_size)
+        self._learn_lock = threading.Lock()
+
+    def _init_freq(self):
+        self._templates_dict = {index: name for name, index in self._templates}
+        for freq in self._template_freq.values():
+            self._freq_total += freq
+
+    def _build_index(self):
+        # 模板集合变化后重建索引，并使缓存的匹配结果失效
+        self._index = TemplateIndex(self._templates, self.log_parse_similarity_threshold)
+        self._template_cache.clear()
+
+    @timed('scan_templates')
     def _scan_tpl_source(self):
-        print('正在扫描日志...')
-        files = os.scandir(self._tpl_source)
-        for file in files:
-            df = pd.read_csv(file)
-            for index, event in df.iterrows():
-                log = event['triggername'].split(' ', 1)[1]
-                self._source_log_entries.append(log)
+        logger.info('正在扫描日志...')
+        # 按文件名顺序扫描，保证同样的训练目录总是得到同样的模板编号
+        for file in source_files(self._tpl_source):
+            df = pd.read_csv(file, usecols=['triggername'])
+            self._source_log_entries.extend(df['triggername'].str.split(' ', n=1).str[1].tolist())
 
+    @timed('mine_templates')
     def _get_templates(self):
         log_entries = self._source_log_entries
 
-        print('正在解析日志模板...')
+        logger.info('正在解析日志模板...')
         cnt = len(log_entries)
         components = UnionSet(cnt)
 
-        print('正在进行第一趟解析，根据重复项建立模板')
-        for entry_id_1 in tqdm(range(cnt)):
-            for entry_id_2 in range(cnt):
-                if entry_id_1 == entry_id_2:
-                    continue
-                if log_entries[entry_id_1] != log_entries[entry_id_2]:
-                    continue
-                components.merge(entry_id_1, entry_id_2)
+        logger.info('正在进行第一趟解析，根据重复项建立模板')
+        # 与两两比较的合并顺序一致：同一文本的所有条目都并入其最后一次出现的条目
+        last_entry_id = {}
+        for entry_id, entry in enumerate(log_entries):
+            last_entry_id[entry] = entry_id
+        for entry_id, entry in enumerate(log_entries):
+            components.merge(entry_id, last_entry_id[entry])
 
-        print('正在进行第二趟解析，根据文本相似度大小进一步建立模板')
+        logger.info('正在进行第二趟解析，根据文本相似度大小进一步建立模板')
         roots_list = list(components.iter_roots())
-        for root1 in tqdm(roots_list):
-            for root2 in roots_list:
-                if root1 == root2:
-                    continue
-                if calc_similarity(log_entries[root1], log_entries[root2]) > self._log_parse_similarity_threshold:
-                    components.merge(root1, root2)
+        for root1, root2 in self._iter_similar_pairs([log_entries[root] for root in roots_list]):
+            components.merge(roots_list[root1], roots_list[root2])
 
         index = 0
+        template_of_root = {}
         for root in components.iter_roots():
             self._templates.append((log_entries[root], index))
             self._template_freq[index] = 0
+            template_of_root[root] = index
             index += 1
-
-        print('正在统计出现频率')
-        for entry in tqdm(self._source_log_entries):
-            self._template_freq[self.get_template_id(entry)] += 1
-
-        print('发现{}个日志模板'.format(index))
+        self._build_index()
+
+        logger.info('正在统计出现频率')
+        # 按条目所属的集合计数：链式合并时条目不一定与其集合的代表文本相似，重新匹配可能找不到模板
+        for entry_id in tqdm(range(cnt)):
+            self._template_freq[template_of_root[components.find(entry_id)]] += 1
+
+        logger.info('发现%d个日志模板', index)
+
+    def _iter_similar_pairs(self, messages):
+        # 以字符出现与否构建稀疏矩阵，分块计算余弦相似度，按照(行, 列)的顺序产出超过阈值的下标对
+        vocabulary = {}
+        indices = []
+        indptr = [0]
+        for message in messages:
+            indices.extend(vocabulary.setdefault(ch, len(vocabulary)) for ch in set(message))
+            indptr.append(len(indices))
+        cnt = len(messages)
+        incidence = sparse.csr_matrix((np.ones(len(indices), dtype=np.int32), indices, indptr),
+                                      shape=(cnt, len(vocabulary)))
+        incidence_t = incidence.T.tocsc()
+        norms = np.sqrt(np.diff(incidence.indptr))
+
+        block = max(1, self.similarity_block_elements // max(cnt, 1))
+        for start in tqdm(range(0, cnt, block)):
+            end = min(start + block, cnt)
+            common = (incidence[start:end] @ incidence_t).tocsr()
+            common.sort_indices()
+            rows = np.repeat(np.arange(start, end), np.diff(common.indptr))
+            cols = common.indices
+            similarity = common.data / norms[rows] / norms[cols]
+            hit = (similarity > self._log_parse_similarity_threshold) & (rows != cols)
+            for root1, root2 in zip(rows[hit].tolist(), cols[hit].tolist()):
+                yield root1, root2
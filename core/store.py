@@ -0,0 +1,355 @@
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from core.clustering import Clustering
+from core.log import fields
+from core.relationship import Relationship, learned_files
+from core.scanner import TemplateScanner, source_files
+from core.topology import Topology
+from settings import Settings
+
+logger = logging.getLogger(__name__)
+
+# 模型文件的魔数
+_MAGIC = b'RCAMODEL'
+# 模型文件的格式版本，格式或训练方式变化时递增，旧版本的模型文件将被重新训练覆盖
+FORMAT_VERSION = 1
+# 各数组段的起始位置按该字节数对齐，内存映射后可以直接作为numpy数组使用
+_ALIGNMENT = 64
+# 进程的umask，mkstemp创建的临时文件权限为0600，替换目标文件前按umask改为普通文件的默认权限。
+# os.umask只能通过设置来读取，在导入时读取一次，避免运行时与其他线程创建文件相互影响
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class ModelStoreError(Exception):
+    """
+    模型文件无法读取（格式不符、版本不符、内容损坏）
+    """
+
+
+def write_bundle(path, meta, arrays):
+    """
+    将元信息和若干numpy数组写入一个模型文件。
+    文件格式：魔数(8字节) | 头部长度(8字节，小端) | 头部(JSON) | 对齐填充 | 各数组段，
+    头部记录格式版本、元信息、各数组的dtype、形状、偏移量以及全部数组段的CRC32校验值。
+    先写入临时文件再整体替换（见write_atomic），读取方不会读到写了一半的文件
+    :param path: 模型文件路径
+    :param meta: 元信息（可以JSON序列化的dict）
+    :param arrays: 数组字典，键为数组名
+    :return: 无
+    """
+
+    layout = {}
+    size = 0
+    for name, array in arrays.items():
+        size = _align(size)
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': size}
+        size += array.nbytes
+
+    payload = bytearray(size)
+    for name, array in arrays.items():
+        offset = layout[name]['offset']
+        payload[offset:offset + array.nbytes] = np.ascontiguousarray(array).tobytes()
+
+    header = json.dumps({
+        'version': FORMAT_VERSION,
+        'meta': meta,
+        'arrays': layout,
+        'checksum': zlib.crc32(payload)
+    }).encode('utf-8')
+    prefix = _MAGIC + struct.pack('<Q', len(header)) + header
+    write_atomic(path, [prefix, bytes(_align(len(prefix)) - len(prefix)), payload])
+
+
+def write_atomic(path, chunks):
+    """
+    将内容写入同目录下各写入方独有的临时文件，再整体替换目标文件：
+    多个进程同时写同一个文件时不会相互截断或交错，最后完成替换的写入方的内容生效。
+    目标文件的权限与open创建的文件相同（0666去掉umask）
+    :param path: 目标文件路径
+    :param chunks: 依次写入的bytes列表
+    :return: 无
+    """
+
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='{}.'.format(name), suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_bundle(path):
+    """
+    以内存映射方式读取模型文件，数组直接引用映射的内存（只读），不复制
+    :param path: 模型文件路径
+    :return: 元组(元信息, 数组字典)
+    """
+
+    try:
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if buffer[:len(_MAGIC)] != _MAGIC:
+            raise ModelStoreError('不是模型文件')
+        header_size = struct.unpack_from('<Q', buffer, len(_MAGIC))[0]
+        header_start = len(_MAGIC) + 8
+        header = json.loads(buffer[header_start:header_start + header_size].decode('utf-8'))
+    except (ValueError, struct.error) as e:
+        raise ModelStoreError('模型文件头部损坏: {}'.format(e))
+
+    if header['version'] != FORMAT_VERSION:
+        raise ModelStoreError('模型文件版本为{}，当前版本为{}'.format(header['version'], FORMAT_VERSION))
+    data_start = _align(header_start + header_size)
+    if zlib.crc32(buffer[data_start:]) != header['checksum']:
+        raise ModelStoreError('模型文件校验失败')
+
+    arrays = {}
+    for name, desc in header['arrays'].items():
+        dtype = np.dtype(desc['dtype'])
+        count = int(np.prod(desc['shape']))
+        if count == 0:
+            arrays[name] = np.empty(desc['shape'], dtype=dtype)
+        else:
+            arrays[name] = np.frombuffer(buffer, dtype=dtype, count=count,
+                                         offset=data_start + desc['offset']).reshape(desc['shape'])
+    return header['meta'], arrays
+
+
+class TemplateJournal:
+    """
+    在线学习的日志模板记录
+    在线学习到的日志模板追加写入模型文件旁的文本文件（每行一个JSON），不重写模型文件，模型文件下次保存时一并写入。
+    多个进程（如多进程部署的服务）共用同一个模型文件时，分配模板分类ID前持有文件锁并先读入其他进程追加的模板，
+    各进程对同一个分类ID的含义保持一致
+    """
+
+    def __init__(self, path):
+        """
+        构造函数
+        :param path: 记录文件路径
+        """
+
+        self._path = path
+        # 本进程已经读到的位置
+        self._offset = 0
+        self._lock = threading.Lock()
+
+    def update(self, learn):
+        """
+        在进程内和跨进程的锁内读入其他进程追加的模板，交给learn处理后追加learn返回的新模板
+        :param learn: 函数，参数为记录中尚未读到的模板列表（元素为dict，包含id，message，count），
+                      返回(新的模板列表, 记录是否与已有模板一致)，不一致时（记录来自其他模型）清空记录
+        :return: 无
+        """
+
+        with self._lock, open(self._path, 'a+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                result = self._read(f, self._offset)
+                if result is None or result[1]:
+                    # 记录被其他进程清空或重写过，从头读取
+                    result = self._read(f, 0)
+                    if result[1]:
+                        logger.warning('在线学习的日志模板记录中有无法解析的行，已跳过',
+                                       extra=fields(path=self._path, lines=result[1]))
+                entries, _, end = result
+                learned, is_consistent = learn(entries)
+                if not is_consistent:
+                    logger.warning('在线学习的日志模板记录与当前模型不一致，已清空', extra=fields(path=self._path))
+                    f.truncate(0)
+                elif f.seek(0, os.SEEK_END) > end:
+                    # 末尾不完整的一行是写入过程中退出的进程留下的，删除后再追加，否则新的记录会接在这一行后面无法解析
+                    logger.warning('在线学习的日志模板记录末尾有不完整的一行，已删除', extra=fields(path=self._path))
+                    f.truncate(end)
+                f.write(b''.join((json.dumps(entry, ensure_ascii=False) + '\n').encode('utf-8') for entry in learned))
+                f.flush()
+                self._offset = f.tell()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def reset(self):
+        """
+        清空记录（重新训练后原有的模板分类ID不再有意义）
+        :return: 无
+        """
+
+        with self._lock:
+            write_atomic(self._path, [])
+            self._offset = 0
+
+    def _read(self, f, offset):
+        # 读取offset之后的完整行，返回(模板列表, 无法解析的行数, 最后一个完整行的结束位置)，文件比offset短时返回None
+        f.seek(0, os.SEEK_END)
+        if f.tell() < offset:
+            return None
+        f.seek(offset)
+        content = f.read()
+        end = content.rfind(b'\n') + 1
+        entries = []
+        n_invalid = 0
+        for line in content[:end].split(b'\n'):
+            if not line:
+                continue
+            try:
+                entry = json.loads(line.decode('utf-8'))
+            except ValueError:
+                entry = None
+            if isinstance(entry, dict):
+                entries.append(entry)
+            else:
+                n_invalid += 1
+        return entries, n_invalid, offset + end
+
+
+class ModelStore:
+    """
+    模型文件
+    将日志模板及其频率、拓扑索引、训练数据、根因推理图、条件概率表和变量消解顺序保存在一个二进制文件中，
+    并以训练输入（模板训练数据、训练数据、增量学习的事件文件、拓扑文件）的内容和训练参数的哈希值作为键：
+    键一致时直接内存映射加载，不一致（输入或参数变化）时重新训练，不会误用过期的模型。
+    在线学习到的日志模板先追加到模型文件旁的记录中（见TemplateJournal），加载时读入，模型文件下次保存时一并写入
+    """
+
+    def __init__(self, path=None):
+        """
+        构造函数
+        :param path: 模型文件路径，为None时使用Settings.model_path
+        """
+
+        self._path = path or Settings.model_path
+        self._fingerprint = None
+        self._journal = TemplateJournal('{}.templates'.format(self._path))
+        # 增量学习与在线学习模板可能同时保存模型
+        self._save_lock = threading.Lock()
+
+    def fingerprint(self):
+        """
+        计算当前训练输入和训练参数的哈希值
+        :return: 十六进制字符串
+        """
+
+        digest = hashlib.sha256()
+        digest.update(json.dumps(self._params(), sort_keys=True).encode('utf-8'))
+        for path in self._inputs():
+            digest.update(os.path.basename(path).encode('utf-8'))
+            with open(path, 'rb') as f:
+                content = f.read()
+            digest.update(struct.pack('<Q', len(content)))
+            digest.update(content)
+        return digest.hexdigest()
+
+    def load(self):
+        """
+        加载模型：模型文件存在且键与当前训练输入一致时直接加载，否则重新训练并保存
+        :return: 元组(日志模板扫描器, 拓扑结构, 根因推理模型)
+        """
+
+        self._fingerprint = self.fingerprint()
+        if os.path.exists(self._path):
+            try:
+                meta, arrays = read_bundle(self._path)
+            except ModelStoreError as e:
+                logger.warning('模型文件不可用（%s），重新训练', e)
+            else:
+                if meta['fingerprint'] == self._fingerprint:
+                    logger.info('从模型文件加载', extra=fields(path=self._path))
+                    tpl, top, relationship = self._restore(arrays)
+                    tpl.sync_templates()
+                    return tpl, top, relationship
+                logger.info('训练数据或参数已变化，重新训练', extra=fields(path=self._path))
+
+        self._journal.reset()
+        tpl = TemplateScanner(Settings.test_data_path, self._journal)
+        top = Topology(Settings.topology_data_path)
+        relationship = Relationship(tpl, top, self)
+        self.save(tpl, top, relationship)
+        return tpl, top, relationship
+
+    def save(self, tpl: TemplateScanner, top: Topology, relationship: Relationship):
+        """
+        保存模型（增量学习后由Relationship调用），键仍为训练输入的哈希值，本进程已知的在线学习到的日志模板一并保存
+        :param tpl: 日志模板扫描器
+        :param top: 拓扑结构
+        :param relationship: 根因推理模型
+        :return: 无
+        """
+
+        if self._fingerprint is None:
+            self._fingerprint = self.fingerprint()
+        arrays = {}
+        for prefix, component in (('templates', tpl), ('topology', top), ('relationship', relationship)):
+            for name, array in component.to_arrays().items():
+                arrays['{}/{}'.format(prefix, name)] = array
+        with self._save_lock:
+            write_bundle(self._path, {'fingerprint': self._fingerprint, 'params': self._params()}, arrays)
+
+    def add_incident(self, content):
+        """
+        将增量学习的事件文件保存为训练输入（由Relationship调用），模型的键随之更新，
+        训练输入或参数变化而重新训练时，增量学习的事件不会丢失
+        :param content: 带根因标记的csv文件内容（bytes）
+        :return: 保存的文件路径
+        """
+
+        os.makedirs(Settings.learned_data_path, exist_ok=True)
+        # 文件名按保存时间排序，加上进程号避免多个进程同时保存时重名
+        path = os.path.join(Settings.learned_data_path, '{:020d}-{}.csv'.format(time.time_ns(), os.getpid()))
+        write_atomic(path, [content])
+        self._fingerprint = None
+        return path
+
+    def remove_incident(self, path):
+        """
+        删除add_incident保存的事件文件（增量学习失败时由Relationship调用）
+        :param path: add_incident返回的文件路径
+        :return: 无
+        """
+
+        os.remove(path)
+        self._fingerprint = None
+
+    def _restore(self, arrays):
+        components = {}
+        for key, array in arrays.items():
+            prefix, name = key.split('/', 1)
+            components.setdefault(prefix, {})[name] = array
+        tpl = TemplateScanner.from_arrays(components['templates'], self._journal)
+        top = Topology.from_arrays(components['topology'])
+        relationship = Relationship.from_arrays(tpl, top, components['relationship'], self)
+        return tpl, top, relationship
+
+    def _params(self):
+        return {
+            'log_parse_similarity_threshold': TemplateScanner.log_parse_similarity_threshold,
+            'freq_threshold': Clustering.freq_threshold,
+            'dag_edge_threshold': Relationship.dag_edge_threshold,
+            'dag_edge_order': Relationship.dag_edge_order,
+            'equivalent_sample_size': Relationship.equivalent_sample_size,
+            'n_training_data': Settings.n_training_data
+        }
+
+    def _inputs(self):
+        training_files = ['{}/{}.csv'.format(Settings.training_data_path, i) for i in range(Settings.n_training_data)]
+        return source_files(Settings.test_data_path) + training_files + learned_files() + [Settings.topology_data_path]
+
+
+def _align(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
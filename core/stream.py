@@ -0,0 +1,210 @@
+import heapq
+import itertools
+import time
+from datetime import datetime
+
+from core.clustering import Clustering
+from core.infer import Infer
+from core.metrics import timed
+from core.relationship import Relationship
+from core.scanner import LogEvent, TemplateScanner
+from core.topology import Topology
+
+
+class StreamingInfer:
+    """
+    流式推理实现类
+    在告警的time列上维护一个滑动时间窗口，告警逐条到达（或移出窗口）时增量更新 节点 -> 事件 的映射和事件计数，
+    并只把拓扑上可能受影响的节点（该告警所在节点及跳数范围之内能够到达它的节点）标记为需要重新计算，
+    定位时只重新计算这些节点的根因候选，其余候选直接复用。
+    与Infer对窗口内的告警整体推理相比：频率过滤、去重、按拓扑聚类、打分和排序的规则相同，
+    所有事件频率都以窗口内的告警条数l为分母，因此候选之间的排序只需比较计数，不随l变化而重新计算
+    """
+
+    # 滑动窗口的长度（秒）
+    window_seconds = 600
+    # 聚类（收集证据）的跳数、输出根因附近局部拓扑的跳数、候选得分的下限，与Infer一致
+    cluster_jumps = Infer.cluster_jumps
+    around_jumps = Infer.around_jumps
+    min_score = Infer.min_score
+
+    def __init__(self, tpl: TemplateScanner, top: Topology, re: Relationship, window_seconds=None):
+        """
+        构造方法，初始化
+        :param tpl: 模板扫描器
+        :param top: 拓扑图
+        :param re: 根因推理图
+        :param window_seconds: 滑动窗口的长度（秒），为None时使用类属性window_seconds
+        """
+
+        self._tpl = tpl
+        self._top = top
+        self._re = re
+        self._window_seconds = self.window_seconds if window_seconds is None else window_seconds
+
+        # 窗口内的告警：(时间戳, 序号, 节点, 日志模板分类ID, 文字信息)，按时间戳排列的堆
+        self._window = []
+        self._sequence = itertools.count()
+        self._watermark = None
+        # 窗口内(节点, 日志模板分类ID)的出现次数
+        self._pair_counts = {}
+        # 节点 -> {(日志模板分类ID, 文字信息): 出现次数}，即去重后的事件，按首次出现的顺序排列
+        self._node_logs = {}
+        self._node_sequence = {}
+        # 节点 -> 该节点的根因候选列表，元素为(以计数表示的得分, 后验概率, 根因事件)
+        self._candidates = {}
+        self._dirty = set()
+        self._upstream = {}
+        self._is_high_freq = {}
+
+    def __len__(self):
+        return len(self._window)
+
+    def push(self, event, timestamp):
+        """
+        接收一条告警
+        :param event: 告警的triggername（主机名 事件内容主体文字信息）
+        :param timestamp: 告警时间，秒
+        :return: 告警是否进入窗口（早于窗口、高频或无法匹配日志模板的告警会被忽略）
+        :raises ValueError: 告警无法解析（缺少事件内容主体或无法解析出节点）时抛出，窗口不受影响
+        """
+
+        node, message = _parse_event(event)
+        if self._watermark is None or timestamp > self._watermark:
+            self._watermark = timestamp
+            self._expire()
+        if timestamp <= self._watermark - self._window_seconds:
+            return False
+
+        template = self._tpl.get_template_id(message)
+        if template is None and self._tpl.learn_unmatched:
+            template = self._tpl.learn_templates([message])[0]
+        if template is None or self._high_freq(template):
+            return False
+
+        heapq.heappush(self._window, (timestamp, next(self._sequence), node, template, message))
+        self._count(node, template, message, 1)
+        return True
+
+    @timed('stream_locate')
+    def locate(self):
+        """
+        根据当前窗口内的告警定位根因，只重新计算上次定位之后受影响节点的候选
+        :return: 推理结果，同Infer.infer：元组(节点, 耗时, 根因告警信息, 节点的局部拓扑子图, 节点 -> 事件)，
+                 不存在根因时为(None, 耗时)
+        """
+
+        start_time = time.perf_counter()
+
+        self._update_candidates()
+        l = len(self._window)
+        best = None
+        best_key = None
+        for node, candidates in self._candidates.items():
+            for i, (score, phi, root_log) in enumerate(candidates):
+                if score < self.min_score * l * l:
+                    continue
+                key = (score * phi, -self._node_sequence[node], -i)
+                if best_key is None or key > best_key:
+                    best, best_key = (node, root_log), key
+
+        if best is None:
+            return None, 1000 * (time.perf_counter() - start_time)
+
+        node, root_log = best
+        around = self._top.neighborhood(node, self._node_logs, self.around_jumps)
+
+        return node, 1000 * (time.perf_counter() - start_time), root_log.message, around,\
+            {v: self._get_logs(v) for v in around.nodes}
+
+    def _expire(self):
+        cutoff = self._watermark - self._window_seconds
+        while self._window and self._window[0][0] <= cutoff:
+            timestamp, sequence, node, template, message = heapq.heappop(self._window)
+            self._count(node, template, message, -1)
+
+    def _count(self, node, template, message, delta):
+        # 更新计数，并将该节点以及可能把该节点聚类进来的节点标记为需要重新计算
+        pair = (node, template)
+        self._pair_counts[pair] = self._pair_counts.get(pair, 0) + delta
+        if self._pair_counts[pair] == 0:
+            del self._pair_counts[pair]
+
+        logs = self._node_logs.get(node)
+        if logs is None:
+            logs = self._node_logs[node] = {}
+            self._node_sequence[node] = next(self._sequence)
+        key = (template, message)
+        logs[key] = logs.get(key, 0) + delta
+        if logs[key] == 0:
+            del logs[key]
+            if not logs:
+                del self._node_logs[node]
+                del self._node_sequence[node]
+
+        upstream = self._upstream.get(node)
+        if upstream is None:
+            upstream = self._upstream[node] = self._top.upstream(node, self.cluster_jumps)
+        self._dirty.add(node)
+        self._dirty.update(upstream)
+
+    def _update_candidates(self):
+        root_templates = self._re.get_root_templates()
+        pending = []
+        for node in self._dirty:
+            self._candidates.pop(node, None)
+            if node not in self._node_logs:
+                continue
+            evidence_nodes = self._top.neighborhood(node, self._node_logs, self.cluster_jumps).nodes[1:]
+            if len(evidence_nodes) == 0:
+                continue
+
+            tot_count = 0
+            evidence = set()
+            for evidence_node in evidence_nodes:
+                for template, message in self._node_logs[evidence_node]:
+                    evidence.add(template)
+                    tot_count += self._pair_counts[(evidence_node, template)]
+
+            for template, message in self._node_logs[node]:
+                if template not in root_templates:
+                    continue
+                count = self._pair_counts[(node, template)]
+                pending.append((node, (tot_count + count) * count, template, message, evidence - {template}))
+        self._dirty.clear()
+
+        phis = self._re.get_possibilities_when([(template, evidence_query)
+                                                for node, score, template, message, evidence_query in pending])
+        for (node, score, template, message, evidence_query), phi in zip(pending, phis):
+            root_log = LogEvent(node, message, template)
+            self._candidates.setdefault(node, []).append((score, phi, root_log))
+
+    def _get_logs(self, node):
+        return [LogEvent(node, message, template) for template, message in self._node_logs.get(node, ())]
+
+    def _high_freq(self, template):
+        is_high_freq = self._is_high_freq.get(template)
+        if is_high_freq is None:
+            is_high_freq = self._is_high_freq[template] = self._tpl.get_freq(template) > Clustering.freq_threshold
+        return is_high_freq
+
+
+def _parse_event(event):
+    # 拆分triggername为节点和事件内容主体文字信息
+    try:
+        host, message = event.split(' ', 1)
+        node = int(host.split('_')[1])
+    except (ValueError, IndexError):
+        raise ValueError('无法解析的告警: {!r}'.format(event))
+    if not message:
+        raise ValueError('告警缺少事件内容主体: {!r}'.format(event))
+    return node, message
+
+
+def parse_time(value):
+    """
+    将告警的time列（%Y-%m-%d %H:%M:%S）转换为秒
+    :param value: time列的值
+    :return: 秒
+    """
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S').timestamp()
@@ -1,14 +1,50 @@
 import json
 
 import networkx as nx
+import numpy as np
+from scipy import sparse
+
+from core.metrics import timed
+
+
+class Neighborhood:
+    """
+    节点附近的局部拓扑（子图的轻量视图）
+    只记录节点和边的列表，接口与networkx图的nodes、edges保持一致，需要时可以导出为networkx图
+    """
+
+    def __init__(self, nodes, edges):
+        """
+        构造函数
+        :param nodes: 节点列表，第一个节点为起始节点
+        :param edges: 边列表
+        """
+
+        self.nodes = nodes
+        self.edges = edges
+
+    def to_nx(self):
+        """
+        导出为networkx图（调试或可视化时用）
+        :return: networkx图
+        """
+
+        subgraph = nx.DiGraph()
+        subgraph.add_nodes_from(self.nodes)
+        subgraph.add_edges_from(self.edges)
+        return subgraph
 
 
 class Topology:
     """
     拓扑结构
-    （拓展networkx的相关功能）
+    以CSR（压缩稀疏行）整数数组存储有向边，节点ID排序后存放在数组中，边的终点以节点在该数组中的下标表示，
+    可以承载数十万节点、数百万条边的规模；需要networkx图时（调试、可视化）再导出
     """
 
+    # 节点后继缓存的容量（节点个数）
+    adjacency_cache_size = 65536
+
     def __init__(self, node_topology_json_path):
         """
         构造函数，从JSON文件中加载拓扑结构
@@ -16,13 +52,141 @@ class Topology:
         """
 
         graph = json.load(open(node_topology_json_path, 'r'))
-        self.nx = nx.DiGraph()
+        node_ids = {}
+
+        def parse_node_id(name):
+            node_id = node_ids.get(name)
+            if node_id is None:
+                node_id = node_ids[name] = int(name.split('_')[1])
+            return node_id
 
+        sources = []
+        targets = []
         for node, children in graph.items():
-            u = int(node.split('_')[1])
+            u = parse_node_id(node)
             for child in children:
-                v = int(child.split('_')[1])
-                self.nx.add_edge(v, u)
+                sources.append(parse_node_id(child))
+                targets.append(u)
+
+        self._build(np.array(sources, dtype=np.int64), np.array(targets, dtype=np.int64))
+        self._adjacency_cache = {}
+        self._reverse = None
+        self._nx = None
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        从to_arrays导出的数组恢复拓扑结构（数组可以是内存映射的只读数组，无需复制）
+        :param arrays: 数组字典
+        :return: Topology
+        """
+
+        top = cls.__new__(cls)
+        top._node_ids = arrays['node_ids']
+        top._node_order = arrays['node_order']
+        top._indptr = arrays['indptr']
+        top._indices = arrays['indices']
+        top._adjacency_cache = {}
+        top._reverse = None
+        top._nx = None
+        return top
+
+    def to_arrays(self):
+        """
+        将CSR结构导出为数组，用于保存到模型文件
+        :return: 数组字典
+        """
+
+        return {
+            'node_ids': self._node_ids,
+            'node_order': self._node_order,
+            'indptr': self._indptr,
+            'indices': self._indices
+        }
+
+    def __len__(self):
+        return len(self._node_ids)
+
+    def __contains__(self, node):
+        return self._position(node) is not None
+
+    @property
+    def nx(self):
+        """
+        networkx形式的拓扑图（首次访问时导出）
+        :return: networkx图
+        """
+
+        if self._nx is None:
+            self._nx = self.to_nx()
+        return self._nx
+
+    def to_nx(self):
+        """
+        导出为networkx图（调试或可视化时用）
+        :return: networkx图
+        """
+
+        graph = nx.DiGraph()
+        graph.add_nodes_from(self.nodes())
+        sources = np.repeat(self._node_ids, np.diff(self._indptr))
+        graph.add_edges_from(zip(sources.tolist(), self._node_ids[self._indices].tolist()))
+        return graph
+
+    def nodes(self):
+        """
+        获取所有节点（按在拓扑文件中首次出现的顺序）
+        :return: 节点列表
+        """
+        return self._node_ids[self._node_order].tolist()
+
+    def successors(self, node):
+        """
+        获取节点的所有后继节点
+        :param node: 节点
+        :return: 后继节点列表，节点不存在时为空列表
+        """
+
+        position = self._position(node)
+        if position is None:
+            return []
+        return [v_id for v, v_id in self._adjacency(position)]
+
+    def upstream(self, node, depth_limit):
+        """
+        获取跳数范围之内能够到达该节点的所有节点（沿边的反方向按层展开），
+        即以这些节点为起点的neighborhood可能包含该节点
+        :param node: 节点
+        :param depth_limit: 深度限制
+        :return: 节点集合，不包含该节点本身
+        """
+
+        position = self._position(node)
+        if position is None:
+            return set()
+        if self._reverse is None:
+            # 反向的CSR结构在第一次使用时构建
+            order = np.argsort(self._indices, kind='stable')
+            sources = np.repeat(np.arange(len(self._node_ids), dtype=np.int32), np.diff(self._indptr))
+            indptr = np.zeros(len(self._node_ids) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self._indices, minlength=len(self._node_ids)), out=indptr[1:])
+            self._reverse = (indptr, sources[order])
+        indptr, indices = self._reverse
+
+        visited = {position}
+        frontier = [position]
+        for _ in range(depth_limit):
+            next_frontier = []
+            for v in frontier:
+                for u in indices[indptr[v]:indptr[v + 1]].tolist():
+                    if u not in visited:
+                        visited.add(u)
+                        next_frontier.append(u)
+            if not next_frontier:
+                break
+            frontier = next_frontier
+        visited.discard(position)
+        return set(self._node_ids[list(visited)].tolist())
 
     def dfs(self, source, is_available=lambda u, v: True, depth_limit=None):
         """
@@ -34,17 +198,17 @@ class Topology:
         """
 
         if source is None:
-            nodes = self.nx
+            nodes = self.nodes()
         else:
             nodes = [source]
         visited = set()
         if depth_limit is None:
-            depth_limit = len(self.nx)
+            depth_limit = len(self)
         for start in nodes:
             if start in visited:
                 continue
             visited.add(start)
-            stack = [(start, depth_limit, iter(self.nx[start]))]
+            stack = [(start, depth_limit, iter(self.successors(start)))]
             while stack:
                 parent, depth_now, children = stack[-1]
                 try:
@@ -54,10 +218,11 @@ class Topology:
                     if child not in visited and is_available(parent, child):
                         visited.add(child)
                         if depth_now > 1:
-                            stack.append((child, depth_now - 1, iter(self.nx[child])))
+                            stack.append((child, depth_now - 1, iter(self.successors(child))))
                 except StopIteration:
                     stack.pop()
 
+    @timed('subgraph_around')
     def subgraph_around(self, source, is_available=lambda u, v: True, depth_limit=3):
         """
         按照深度优先遍历得到的边建立子图
@@ -74,3 +239,179 @@ class Topology:
             subgraph.add_edge(u, v)
 
         return subgraph
+
+    def neighborhood(self, source, members=None, depth_limit=3):
+        """
+        获取节点附近跳数范围之内的局部拓扑，只经过members中的节点
+        按层展开，跳数按最短路径计算，相当于subgraph_around(source, lambda u, v: v in members, depth_limit)
+        :param source: 起始节点
+        :param members: 可经过的节点，可以是node_mask得到的掩码，也可以是任意支持in运算的节点集合，为None时不做限制
+        :param depth_limit: 深度限制
+        :return: Neighborhood
+        """
+
+        position = self._position(source)
+        if position is None:
+            return Neighborhood([source], [])
+
+        is_mask = isinstance(members, np.ndarray)
+        nodes = [source]
+        edges = []
+        visited = {position}
+        frontier = [(position, source)]
+        for _ in range(depth_limit):
+            next_frontier = []
+            for u, u_id in frontier:
+                for v, v_id in self._adjacency(u):
+                    if members is not None and not (members[v] if is_mask else v_id in members):
+                        continue
+                    edges.append((u_id, v_id))
+                    if v not in visited:
+                        visited.add(v)
+                        nodes.append(v_id)
+                        next_frontier.append((v, v_id))
+            if not next_frontier:
+                break
+            frontier = next_frontier
+        return Neighborhood(nodes, edges)
+
+    @timed('reachability')
+    def reachability(self, nodes, depth_limit):
+        """
+        一次性计算一组节点两两之间的可达关系：只经过这组节点、跳数在范围之内。
+        结果与对每个节点分别调用neighborhood(node, nodes, depth_limit)得到的节点（不含起始节点）相同，
+        以节点导出子图的邻接矩阵的前depth_limit次幂之和得到，计算量与子图的边数成正比
+        :param nodes: 节点列表（不重复）
+        :param depth_limit: 深度限制
+        :return: scipy稀疏矩阵（CSR，nodes × nodes），第i行中非零的列即nodes[i]可以到达的节点
+        """
+
+        n = len(nodes)
+        nodes = np.asarray(nodes, dtype=np.int64).reshape(-1)
+        positions = np.searchsorted(self._node_ids, nodes)
+        found = positions < len(self._node_ids)
+        found[found] = self._node_ids[positions[found]] == nodes[found]
+        local = np.flatnonzero(found)
+        positions = positions[local]
+
+        # 取出这些节点的所有后继，只保留同样属于这组节点的后继
+        starts = self._indptr[positions]
+        counts = self._indptr[positions + 1] - starts
+        rows = np.repeat(local, counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+        targets = self._indices[offsets]
+        order = np.argsort(positions)
+        sorted_positions = positions[order]
+        columns = np.searchsorted(sorted_positions, targets)
+        is_member = columns < len(sorted_positions)
+        is_member[is_member] = sorted_positions[columns[is_member]] == targets[is_member]
+        adjacency = sparse.csr_matrix((np.ones(is_member.sum(), dtype=np.int32),
+                                       (rows[is_member], local[order[columns[is_member]]])), shape=(n, n))
+        adjacency.data[:] = 1
+
+        reach = adjacency
+        frontier = adjacency
+        for _ in range(depth_limit - 1):
+            frontier = frontier @ adjacency
+            frontier.data[:] = 1
+            if frontier.nnz == 0:
+                break
+            reach = reach + frontier
+            reach.data[:] = 1
+        # 不包含起始节点本身（经由环回到自身的情况）
+        reach = (reach - sparse.diags(reach.diagonal(), dtype=reach.dtype)).tocsr()
+        reach.eliminate_zeros()
+        return reach
+
+    def node_mask(self, nodes):
+        """
+        将节点集合转换为按节点下标排列的布尔掩码，供neighborhood的members参数使用，
+        对同一节点集合多次查询时可以避免逐个节点的集合运算
+        :param nodes: 节点集合
+        :return: 布尔数组
+        """
+
+        mask = np.zeros(len(self._node_ids), dtype=bool)
+        nodes = np.fromiter(nodes, dtype=np.int64)
+        positions = np.searchsorted(self._node_ids, nodes)
+        found = positions < len(self._node_ids)
+        found[found] = self._node_ids[positions[found]] == nodes[found]
+        mask[positions[found]] = True
+        return mask
+
+    def _build(self, sources, targets):
+        # 去除重复的边（保留首次出现的顺序），再按起点稳定排序，得到每个节点的后继按加入顺序排列的CSR结构
+        endpoints = np.column_stack([sources, targets]).ravel()
+        self._node_ids, first_seen = np.unique(endpoints, return_index=True)
+        self._node_order = np.argsort(first_seen, kind='stable').astype(np.int32)
+        src = np.searchsorted(self._node_ids, sources)
+        dst = np.searchsorted(self._node_ids, targets)
+        n = len(self._node_ids)
+        _, first = np.unique(src * n + dst, return_index=True)
+        first.sort()
+        src, dst = src[first], dst[first]
+        order = np.argsort(src, kind='stable')
+        self._indices = dst[order].astype(np.int32)
+        self._indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n), out=self._indptr[1:])
+
+    def _adjacency(self, position):
+        # 遍历过的节点的后继（下标, 节点ID）元组缓存起来，遍历时不必每次都访问数组；
+        # 缓存满时整体清空以限制内存（dict的单次读写在GIL下是原子的，多线程共享无需加锁）
+        adjacency = self._adjacency_cache.get(position)
+        if adjacency is None:
+            children = self._indices[self._indptr[position]:self._indptr[position + 1]]
+            adjacency = tuple(zip(children.tolist(), self._node_ids[children].tolist()))
+            if len(self._adjacency_cache) >= self.adjacency_cache_size:
+                self._adjacency_cache.clear()
+            self._adjacency_cache[position] = adjacency
+        return adjacency
+
+    def _position(self, node):
+        position = int(np.searchsorted(self._node_ids, node))
+        if position < len(self._node_ids) and self._node_ids[position] == node:
+            return position
+        return None
+
+
+# 不属于任何系统的节点在系统ID数组中使用的占位值
+NO_SYSTEM = -1
+
+
+class SystemTopology:
+    """
+    系统级拓扑
+    节点所属的系统（SYS_*），以及系统之间的依赖关系（与节点级拓扑的文件格式、边的方向相同，以Topology存储）
+    """
+
+    def __init__(self, system_nodes_json_path, system_topology_json_path):
+        """
+        构造函数，从JSON文件中加载系统级拓扑
+        :param system_nodes_json_path: 系统 -> 节点列表 的JSON文件
+        :param system_topology_json_path: 系统拓扑结构的JSON文件
+        """
+
+        self.graph = Topology(system_topology_json_path)
+        node_systems = {}
+        for system, nodes in json.load(open(system_nodes_json_path, 'r')).items():
+            system_id = int(system.split('_')[1])
+            for node in nodes:
+                node_systems[int(node.split('_')[1])] = system_id
+        self._node_ids = np.array(sorted(node_systems), dtype=np.int64)
+        self._system_ids = np.array([node_systems[node] for node in self._node_ids.tolist()], dtype=np.int64)
+
+    def system_of(self, nodes):
+        """
+        获取各节点所属的系统
+        :param nodes: 节点列表
+        :return: 系统ID数组，不属于任何系统的节点为NO_SYSTEM
+        """
+
+        nodes = np.asarray(nodes, dtype=np.int64).reshape(-1)
+        positions = np.searchsorted(self._node_ids, nodes)
+        found = positions < len(self._node_ids)
+        found[found] = self._node_ids[positions[found]] == nodes[found]
+        systems = np.full(len(nodes), NO_SYSTEM, dtype=np.int64)
+        systems[found] = self._system_ids[positions[found]]
+        return systems
+
@@ -1,22 +1,41 @@
-import os
-import uuid
+import json
+import shutil
+import tempfile
+import zipfile
 
-from flask import Flask, render_template, request, make_response, jsonify
+from flask import Flask, Response, render_template, request, make_response, jsonify, stream_with_context, url_for
 
-from core.clustering import Clustering
+from core import metrics
 from core.infer import Infer
+from core.jobs import JobQueue, JobQueueFull
+from core.log import configure_logging
 from core.relationship import Relationship
-from core.scanner import TemplateScanner
-from core.topology import Topology
+from core.store import ModelStore
+from core.topology import SystemTopology
 from settings import Settings
 
+configure_logging(Settings.log_level, Settings.log_debug_sample_rate)
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = 'upload/'
-app.config['TEMPLATE_SCANNER'] = TemplateScanner(Settings.test_data_path)
-app.config['TOPOLOGY'] = Topology(Settings.topology_data_path)
-app.config['CLUSTERING'] = Clustering(app.config['TEMPLATE_SCANNER'], app.config['TOPOLOGY'])
-app.config['RELATIONSHIP'] = Relationship(app.config['TEMPLATE_SCANNER'], app.config['TOPOLOGY'])
-app.config['INFER'] = Infer(app.config['TEMPLATE_SCANNER'], app.config['TOPOLOGY'], app.config['RELATIONSHIP'])
+# 长轮询查询任务结果时最长的等待时间（秒）
+app.config['MAX_JOB_WAIT'] = 30
+# 批量推理时上传的文件转存到临时文件中，不超过该字节数的文件保存在内存中
+app.config['UPLOAD_SPOOL_SIZE'] = 1 << 20
+
+
+def create_app():
+    """
+    加载模型（没有可用的模型文件时重新训练）并初始化推理实例和任务队列。
+    训练时会启动进程池，而以spawn方式启动的子进程会重新导入主模块，因此不能在导入本模块时加载
+    :return: Flask应用，部署到WSGI服务器时使用该函数创建（如gunicorn 'server:create_app()'）
+    """
+
+    app.config['TEMPLATE_SCANNER'], app.config['TOPOLOGY'], app.config['RELATIONSHIP'] = ModelStore().load()
+    app.config['SYSTEMS'] = SystemTopology(Settings.system_data_path, Settings.system_topology_data_path) \
+        if Settings.hierarchical else None
+    app.config['INFER'] = Infer(app.config['TEMPLATE_SCANNER'], app.config['TOPOLOGY'],
+                                app.config['RELATIONSHIP'], app.config['SYSTEMS'])
+    app.config['JOBS'] = JobQueue()
+    return app
 
 
 @app.route('/')
@@ -24,13 +43,13 @@ def main():
     return render_template('main.html')
 
 
-@app.route('/locate/', methods=['POST'])
-def locate():
-    path = os.path.join(app.config['UPLOAD_FOLDER'], str(uuid.uuid4()))
-    request.files.get('file').save(path)
+def locate_result(res):
+    """
+    将推理结果构造成返回给前端的dict
+    :param res: Infer.infer的返回值
+    :return: dict
+    """
 
-    infer: Infer = app.config['INFER']
-    res = infer.infer(path)
     result = {
         'has_root_cause': res[0] is not None,
         'total_time': res[1]
@@ -38,7 +57,156 @@ def locate():
     if res[0] is not None:
         result['node'], total_time, result['message'], result['subgraph'], result['node_to_log_mapping'] = res
         result['subgraph'] = (list(result['subgraph'].nodes), list(result['subgraph'].edges))
+        result['node_to_log_mapping'] = {node: [log.to_dict() for log in logs]
+                                         for node, logs in result['node_to_log_mapping'].items()}
+    return result
+
+
+def run_locate(infer: Infer, data, with_stages=False):
+    """
+    推理并构造返回给前端的dict
+    :param infer: 推理实现类
+    :param data: csv文件内容
+    :param with_stages: 是否在结果中附带各阶段的耗时（stages，毫秒）
+    :return: dict
+    """
+
+    if not with_stages:
+        return locate_result(infer.infer(data))
+    with metrics.collect_stages() as stages:
+        result = locate_result(infer.infer(data))
+    result['stages'] = {stage: 1000 * seconds for stage, seconds in stages.items()}
+    return result
+
+
+@app.route('/locate/', methods=['POST'])
+def locate():
+    # 上传的文件直接在内存中解析，不写入磁盘；stages=1时返回各阶段的耗时
+    infer: Infer = app.config['INFER']
+    with_stages = request.args.get('stages', 0, type=int) == 1
+    return make_response(jsonify(run_locate(infer, request.files.get('file').read(), with_stages)))
+
+
+def spool_upload(file):
+    """
+    将上传的文件转存到临时文件中（请求结束后werkzeug会关闭上传的文件，而批量推理的结果在响应的过程中才逐个产出）
+    :param file: 上传的文件
+    :return: 临时文件对象，读取位置在开头
+    """
+
+    spooled = tempfile.SpooledTemporaryFile(app.config['UPLOAD_SPOOL_SIZE'])
+    shutil.copyfileobj(file.stream, spooled)
+    spooled.seek(0)
+    return spooled
+
+
+def uploaded_sources(uploads):
+    """
+    将上传的多个文件展开为(文件名, 文件内容)，zip压缩包中的每个csv文件作为一个单独的文件。
+    按需读取：取出下一个元素时才读取（解压）对应的文件，配合Infer.infer_many同时推理的文件数上限，
+    文件很多时不会一次性读入内存。遍历结束（或中途停止）时关闭所有文件
+    :param uploads: (文件名, 文件对象)列表，文件对象由spool_upload得到
+    :return: 一个Python Generator，产出(文件名, 文件内容)
+    """
+
+    try:
+        for filename, stream in uploads:
+            is_zip = zipfile.is_zipfile(stream)
+            stream.seek(0)
+            if not is_zip:
+                yield filename, stream.read()
+                continue
+            with zipfile.ZipFile(stream) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir() and info.filename.endswith('.csv') \
+                            and not info.filename.startswith('__MACOSX/'):
+                        yield info.filename, archive.read(info)
+    finally:
+        for filename, stream in uploads:
+            stream.close()
 
-    os.remove(path)
 
+@app.route('/locate/batch/', methods=['POST'])
+def locate_batch():
+    # 多个文件（或zip压缩包）并行推理，每个文件推理完成后立即以一行JSON（NDJSON）返回，按完成的先后顺序排列
+    infer: Infer = app.config['INFER']
+    uploads = [(file.filename, spool_upload(file)) for file in request.files.getlist('file')]
+
+    def generate():
+        for name, res, error in infer.infer_many(uploaded_sources(uploads)):
+            result = {'file': name}
+            if error is None:
+                result.update(locate_result(res))
+            else:
+                result['error'] = '{}: {}'.format(type(error).__name__, error)
+            yield json.dumps(result, ensure_ascii=False) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.route('/locate/episodes/', methods=['POST'])
+def locate_episodes():
+    # 按时间间隔和拓扑连通性将上传的告警切分为多个事件片段，各片段分别推理，返回每个片段的根因及根因候选的排名
+    infer: Infer = app.config['INFER']
+    episodes = []
+    for episode in infer.infer_episodes(request.files.get('file').read()):
+        result = locate_result(episode.result)
+        result.update({
+            'start': episode.start,
+            'end': episode.end,
+            'n_alarms': len(episode),
+            'ranking': [{'node': node, 'message': message, 'score': score}
+                        for node, message, score in episode.ranking]
+        })
+        episodes.append(result)
+    return make_response(jsonify({'episodes': episodes}))
+
+
+@app.route('/jobs/', methods=['POST'])
+def submit_job():
+    # 提交后立即返回任务ID，推理在任务队列中进行，通过/jobs/<job_id>查询结果
+    infer: Infer = app.config['INFER']
+    jobs: JobQueue = app.config['JOBS']
+    data = request.files.get('file').read()
+    with_stages = request.args.get('stages', 0, type=int) == 1
+    try:
+        job = jobs.submit(run_locate, infer, data, with_stages)
+    except JobQueueFull as e:
+        return make_response(jsonify({'error': str(e)}), 503)
+
+    response = make_response(jsonify(job.to_dict()), 202)
+    response.headers['Location'] = url_for('get_job', job_id=job.job_id)
+    return response
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    # wait参数（秒）不为0时，在任务结束或超时之前不返回（长轮询），结果在任务结束时即推送给客户端
+    jobs: JobQueue = app.config['JOBS']
+    job = jobs.get(job_id)
+    if job is None:
+        return make_response(jsonify({'error': '任务不存在或已过期'}), 404)
+    wait = min(request.args.get('wait', 0, type=float), app.config['MAX_JOB_WAIT'])
+    if wait > 0:
+        job.wait(wait)
+    return make_response(jsonify(job.to_dict()))
+
+
+@app.route('/metrics')
+def get_metrics():
+    # Prometheus文本格式的指标（各阶段耗时的直方图）
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/learn/', methods=['POST'])
+def learn():
+    relationship: Relationship = app.config['RELATIONSHIP']
+    result = {
+        'learned': relationship.learn(request.files.get('file').read())
+    }
     return make_response(jsonify(result))
+
+
+if __name__ == '__main__':
+    # 推理过程没有跨请求共享的可变状态，可以多线程处理请求（也可以交由多进程的WSGI服务器部署）
+    create_app().run(threaded=True)
@@ -3,4 +3,19 @@ class Settings:
     test_data_path = root_path + '/data/test'
     training_data_path = root_path + '/data/train'
     topology_data_path = root_path + '/data/topology/topology_edges_node.json'
+    # 节点所属的系统、系统之间的拓扑结构，层级定位时使用
+    system_data_path = root_path + '/data/topology/sys_and_nodes.json'
+    system_topology_data_path = root_path + '/data/topology/topology_edges_sys.json'
+    # 是否进行层级定位（先定位系统，再在系统内定位节点）
+    hierarchical = False
     n_training_data = 100
+    # 通过增量学习（/learn/）加入的带根因标记的事件文件的保存目录，重新训练时与训练数据一起使用
+    learned_data_path = root_path + '/data/learned'
+    # 模型文件（日志模板、拓扑索引、根因推理图、条件概率表）的路径
+    model_path = root_path + '/data/.model'
+    # 并行处理时的进程数，为None时使用CPU核数
+    n_workers = None
+    # 日志级别（DEBUG时记录每个事件和候选的详细信息）
+    log_level = 'INFO'
+    # DEBUG日志的保留比例，请求量大时可以调低以减少日志量
+    log_debug_sample_rate = 1.0
@@ -0,0 +1,104 @@
+import argparse
+import csv
+import logging
+import sys
+import time
+
+from core.log import LOGGER_NAME, configure_logging, fields
+from core.store import ModelStore
+from core.stream import StreamingInfer, parse_time
+from settings import Settings
+
+# 脚本不在core包内，日志通过core的记录器由configure_logging统一输出
+logger = logging.getLogger(LOGGER_NAME)
+
+
+def follow(path, poll_interval):
+    """
+    类似tail -f：从头读取文件，读到末尾后持续等待新写入的行
+    :param path: 文件路径
+    :param poll_interval: 没有新的行时等待的时间（秒）
+    :return: 一个Python Generator，产出读到的行，暂时没有新的行时产出None
+    """
+
+    with open(path, 'r', encoding='utf-8') as f:
+        partial = ''
+        while True:
+            line = f.readline()
+            if not line:
+                yield None
+                time.sleep(poll_interval)
+                continue
+            partial += line
+            # 写入方可能只写了半行，等到换行符出现再处理
+            if partial.endswith('\n'):
+                yield partial
+                partial = ''
+
+
+def run(lines, infer: StreamingInfer, report_interval):
+    """
+    逐行读取csv格式的告警（第一行为表头，与训练/测试数据文件相同），送入流式推理，
+    每隔report_interval秒（或暂时没有新的告警时）定位一次根因，根因变化时输出。
+    无法处理的行（列数不足、时间格式错误、告警无法解析）记录警告后跳过
+    :param lines: 行的迭代器，None表示暂时没有新的行
+    :param infer: 流式推理
+    :param report_interval: 两次定位之间的最小间隔（秒）
+    :return: 无
+    """
+
+    columns = None
+    latest_time = None
+    last_located = None
+    last_report = time.perf_counter()
+
+    def report():
+        nonlocal last_located
+        result = infer.locate()
+        located = None if result[0] is None else (result[0], result[2])
+        if located != last_located:
+            last_located = located
+            if located is None:
+                print('{} 窗口内{}条告警，未发现根因'.format(latest_time, len(infer)))
+            else:
+                print('{} 根因: node_{} {}（窗口内{}条告警，耗时{:.1f}ms）'.format(
+                    latest_time, result[0], result[2], len(infer), result[1]))
+            sys.stdout.flush()
+
+    for line in lines:
+        if line is not None:
+            row = next(csv.reader([line]), None)
+            if not row:
+                continue
+            if columns is None:
+                columns = {name.lstrip('\ufeff'): i for i, name in enumerate(row)}
+                continue
+            try:
+                row_time = row[columns['time']]
+                infer.push(row[columns['triggername']], parse_time(row_time))
+            except (IndexError, ValueError) as e:
+                logger.warning('跳过无法处理的告警行', extra=fields(line=line.rstrip('\n'), error=str(e)))
+                continue
+            latest_time = row_time
+        if line is None or time.perf_counter() - last_report >= report_interval:
+            last_report = time.perf_counter()
+            report()
+    report()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='流式根因定位：从文件（持续跟踪新写入的行）或标准输入读取告警')
+    parser.add_argument('path', nargs='?', default='-', help='告警csv文件，省略或为-时从标准输入读取')
+    parser.add_argument('--window', type=float, default=StreamingInfer.window_seconds, help='滑动窗口长度（秒）')
+    parser.add_argument('--interval', type=float, default=1.0, help='两次定位之间的最小间隔（秒）')
+    parser.add_argument('--poll', type=float, default=0.2, help='跟踪文件时等待新写入的间隔（秒）')
+    args = parser.parse_args()
+
+    configure_logging(Settings.log_level, Settings.log_debug_sample_rate)
+    tpl, top, re = ModelStore().load()
+    stream_infer = StreamingInfer(tpl, top, re, args.window)
+    source = sys.stdin if args.path == '-' else follow(args.path, args.poll)
+    try:
+        run(source, stream_infer, args.interval)
+    except KeyboardInterrupt:
+        pass
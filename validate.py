@@ -1,46 +1,239 @@
+import argparse
+import hashlib
+import itertools
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 from tqdm import tqdm
 
 from core.clustering import Clustering
-from core.scanner import TemplateScanner
-from core.topology import Topology
+from core.infer import Infer
+from core.scanner import TemplateScanner, source_files
+from core.store import ModelStore
+from core.topology import SystemTopology
+from settings import Settings
 
-if __name__ == '__main__':
-    top = Topology('data/topology/topology_edges_node.json')
-    ts = TemplateScanner('data/test')
-    current = json.load(open('cur2.json', 'r'))
+# 可以扫描的参数：参数名 -> (所属的类, 类属性名)
+PARAMETERS = {
+    'freq_threshold': (Clustering, 'freq_threshold'),
+    'similarity_threshold': (TemplateScanner, 'log_parse_similarity_threshold'),
+    'cluster_jumps': (Infer, 'cluster_jumps'),
+    'top_systems': (Infer, 'top_systems'),
+    'n_training_data': (Settings, 'n_training_data')
+}
+# 只影响推理、不影响训练的参数（训练数据的聚类固定为2跳，不随cluster_jumps变化）
+INFERENCE_PARAMETERS = {'cluster_jumps', 'top_systems'}
+
+# 评估进程中已加载的模型：参数组的键 -> (日志模板扫描器, 拓扑结构, Infer)
+_worker_models = {}
+
+
+def apply_config(config):
+    """
+    将一组参数设置到对应的类属性上
+    :param config: dict，参数名 -> 参数值
+    :return: 无
+    """
+
+    for name, value in config.items():
+        cls, attribute = PARAMETERS[name]
+        setattr(cls, attribute, value)
+
+
+def config_key(config):
+    """
+    获取一组参数的键
+    :param config: dict，参数名 -> 参数值
+    :return: 字符串
+    """
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def model_path(cache_dir, config):
+    """
+    获取一组参数对应的模型文件路径。只有影响训练的参数（INFERENCE_PARAMETERS以外）参与区分，
+    模型文件本身按训练输入和参数的哈希值校验，参数变化后会自动重新训练
+    :param cache_dir: 缓存目录
+    :param config: dict，参数名 -> 参数值
+    :return: 模型文件路径
+    """
+
+    training_config = {name: value for name, value in config.items() if name not in INFERENCE_PARAMETERS}
+    return os.path.join(cache_dir, 'model-{}'.format(config_key(training_config)))
+
+
+def evaluate_file(cache_dir, config, split, path, label=None):
+    """
+    在评估进程中推理一个文件；对于带根因标记的文件，同时获取其标记的根因。
+    推理总是从解析文件开始（耗时为端到端的耗时），标记的根因只与模型有关，可以使用缓存
+    :param cache_dir: 缓存目录
+    :param config: dict，参数名 -> 参数值
+    :param split: 数据集（train或test）
+    :param path: 文件路径
+    :param label: 已缓存的标记的根因(节点, 日志模板分类ID)，为None时解析文件获取
+    :return: dict，包含file，node，template，time，以及（train数据集）root_node，root_template
+    """
+
+    apply_config(config)
+    # 评估时不在线学习日志模板，各文件的结果与评估的先后顺序无关
+    TemplateScanner.learn_unmatched = False
+    key = config_key(config)
+    model = _worker_models.get(key)
+    if model is None:
+        tpl, top, re = ModelStore(model_path(cache_dir, config)).load()
+        # top_systems为0时不进行层级定位
+        systems = SystemTopology(Settings.system_data_path, Settings.system_topology_data_path) \
+            if config.get('top_systems') else None
+        model = _worker_models[key] = (tpl, top, Infer(tpl, top, re, systems))
+    tpl, top, infer = model
+
+    res = infer.infer(path)
+    result = {
+        'file': '{}/{}'.format(split, os.path.basename(path)),
+        'node': res[0],
+        'template': None if res[0] is None else tpl.get_template_id(res[2]),
+        'time': res[1]
+    }
+    if split == 'train':
+        if label is None:
+            root_cause = Clustering(tpl, top, tpl.parse(path, True), True).get_root_cause()
+            label = (None, None) if root_cause is None else (root_cause.node, root_cause.template)
+        result['root_node'], result['root_template'] = label
+    return result
+
+
+def summarize(results):
+    """
+    根据各文件的推理结果计算准确率、召回率、F1以及推理耗时的分位数
+    带根因标记的文件中：定位到的节点和日志模板都与标记一致时算作正确，没有标记但定位到了根因的算作定位错误
+    :param results: evaluate_file的结果列表
+    :return: dict
+    """
 
     n_correct = 0
     n_located = 0
     n_has = 0
-
-    rc_cache = []
-    if not os.path.exists('.rccache'):
-        for i in tqdm(range(100)):
-            ts.init('./data/train/{}.csv'.format(i), root_cause_label=True)
-            cl = Clustering(ts, top, True)
-            rc_cache.append(cl.get_root_cause())
-        json.dump(rc_cache, open('.rccache', 'w'))
-    else:
-        rc_cache = json.load(open('.rccache', 'r'))
-
-    for i in tqdm(range(100)):
-        root_cause = rc_cache[i]
-        if root_cause is None:
-            if str(i) in current:
-                n_located += 1
+    for result in results:
+        if 'root_node' not in result:
             continue
-        n_has += 1
-        if str(i) not in current:
+        if result['root_node'] is not None:
+            n_has += 1
+        if result['node'] is None:
             continue
         n_located += 1
-        if current[str(i)][0]['node'] == root_cause['node'] and current[str(i)][0]['root_log']['template'] == root_cause['template']:
+        if result['node'] == result['root_node'] and result['template'] == result['root_template']:
             n_correct += 1
 
-    precision = n_correct / n_located
-    back = n_correct / n_has
+    precision = n_correct / n_located if n_located else 0
+    recall = n_correct / n_has if n_has else 0
+    times = np.array([result['time'] for result in results])
+    return {
+        'precision': precision,
+        'recall': recall,
+        'f1': 2 * precision * recall / (precision + recall) if precision + recall else 0,
+        'correct': n_correct,
+        'located': n_located,
+        'has_root_cause': n_has,
+        'p50': float(np.percentile(times, 50)),
+        'p90': float(np.percentile(times, 90)),
+        'p99': float(np.percentile(times, 99))
+    }
+
+
+def evaluate(configs, splits, cache_dir, use_cache=True, n_workers=None):
+    """
+    对每一组参数，在进程池中并行推理各数据集的所有文件并汇总评估结果。
+    模型按参数缓存在模型文件中，各文件的推理结果按参数和模型的哈希值缓存，重复评估同一组参数时直接使用缓存；
+    标记的根因按模型的哈希值缓存，只改变推理参数（cluster_jumps、top_systems）时不再重新解析、聚类带标记的文件。
+    推理本身（解析、聚类）不缓存，以测量端到端的耗时
+    :param configs: 参数组列表，元素为dict，参数名 -> 参数值
+    :param splits: 数据集列表，元素为(数据集名称, 文件路径列表)
+    :param cache_dir: 缓存目录
+    :param use_cache: 是否使用已缓存的推理结果（不使用时重新推理并测量耗时）
+    :param n_workers: 进程数，为None时使用Settings.n_workers
+    :return: 与configs一一对应的评估结果列表
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+    pending = []
+    results = []
+    for config in configs:
+        # 模型在主进程中依次训练（或校验缓存），评估进程直接加载模型文件
+        apply_config(config)
+        store = ModelStore(model_path(cache_dir, config))
+        store.load()
+        files = [(split, path) for split, paths in splits for path in paths]
+        fingerprint = store.fingerprint()
+        key = hashlib.sha256(json.dumps([fingerprint, config, files], sort_keys=True).encode('utf-8'))
+        results_path = os.path.join(cache_dir, 'results-{}.json'.format(key.hexdigest()[:16]))
+        if use_cache and os.path.exists(results_path):
+            results.append(json.load(open(results_path, 'r')))
+            continue
+        key = hashlib.sha256(json.dumps([fingerprint, files], sort_keys=True).encode('utf-8'))
+        labels_path = os.path.join(cache_dir, 'labels-{}.json'.format(key.hexdigest()[:16]))
+        labels = json.load(open(labels_path, 'r')) if os.path.exists(labels_path) else {}
+        results.append(None)
+        pending.append((len(results) - 1, results_path, labels_path, labels, config, files))
+
+    tasks = [(i, config, split, path, labels.get(path))
+             for i, results_path, labels_path, labels, config, files in pending for split, path in files]
+    if tasks:
+        outputs = {i: [] for i, results_path, labels_path, labels, config, files in pending}
+        with ProcessPoolExecutor(Settings.n_workers if n_workers is None else n_workers) as executor:
+            futures = [(i, executor.submit(evaluate_file, cache_dir, config, split, path, label))
+                       for i, config, split, path, label in tasks]
+            for i, future in tqdm(futures):
+                outputs[i].append(future.result())
+        for i, results_path, labels_path, labels, config, files in pending:
+            results[i] = outputs[i]
+            json.dump(outputs[i], open(results_path, 'w'))
+            labels = {path: [result['root_node'], result['root_template']]
+                      for (split, path), result in zip(files, outputs[i]) if 'root_node' in result}
+            json.dump(labels, open(labels_path, 'w'))
+
+    return [summarize(file_results) for file_results in results]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='评估根因定位的准确率和耗时，可以同时扫描多组参数。模型、标记的根因和推理结果被缓存；'
+                    '为了测量端到端的耗时，每组参数下各文件的推理（包括解析和聚类）都会重新进行')
+    parser.add_argument('--freq-threshold', type=float, nargs='+', default=[Clustering.freq_threshold],
+                        help='频率过滤阈值')
+    parser.add_argument('--similarity-threshold', type=float, nargs='+',
+                        default=[TemplateScanner.log_parse_similarity_threshold], help='日志模板相似度阈值')
+    parser.add_argument('--cluster-jumps', type=int, nargs='+', default=[Infer.cluster_jumps],
+                        help='推理时聚类的跳数（训练数据的聚类固定为2跳）')
+    parser.add_argument('--top-systems', type=int, nargs='+', default=[0],
+                        help='层级定位时寻找根因候选的系统个数，为0时不进行层级定位')
+    parser.add_argument('--holdout', type=int, default=0,
+                        help='留出最后若干个训练文件不参与训练，只在这些文件上评估；为0时在全部训练文件上评估')
+    parser.add_argument('--no-test', action='store_true', help='不推理测试数据（测试数据没有根因标记，只统计耗时）')
+    parser.add_argument('--workers', type=int, default=None, help='进程数')
+    parser.add_argument('--cache-dir', default='.validate', help='缓存目录')
+    parser.add_argument('--no-cache', action='store_true', help='不使用已缓存的推理结果')
+    args = parser.parse_args()
+
+    n_training_data = Settings.n_training_data - args.holdout
+    evaluation_start = n_training_data if args.holdout else 0
+    splits = [('train', ['{}/{}.csv'.format(Settings.training_data_path, i)
+                         for i in range(evaluation_start, Settings.n_training_data)])]
+    if not args.no_test:
+        splits.append(('test', source_files(Settings.test_data_path)))
+
+    configs = [{'freq_threshold': freq_threshold, 'similarity_threshold': similarity_threshold,
+                'cluster_jumps': cluster_jumps, 'top_systems': top_systems, 'n_training_data': n_training_data}
+               for freq_threshold, similarity_threshold, cluster_jumps, top_systems
+               in itertools.product(args.freq_threshold, args.similarity_threshold, args.cluster_jumps,
+                                    args.top_systems)]
+    summaries = evaluate(configs, splits, args.cache_dir, not args.no_cache, args.workers)
 
-    f1 = 2 * precision * back / (precision + back)
-    print(f1)
+    print('freq  sim   jumps  sys  precision  recall  f1      correct/located/has  p50(ms)  p90(ms)  p99(ms)')
+    for config, summary in zip(configs, summaries):
+        print('{:<5} {:<5} {:<6} {:<4} {:<10.4f} {:<7.4f} {:<7.4f} {:<20} {:<8.1f} {:<8.1f} {:.1f}'.format(
+            config['freq_threshold'], config['similarity_threshold'], config['cluster_jumps'], config['top_systems'],
+            summary['precision'], summary['recall'], summary['f1'],
+            '{}/{}/{}'.format(summary['correct'], summary['located'], summary['has_root_cause']),
+            summary['p50'], summary['p90'], summary['p99']))